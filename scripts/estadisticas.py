@@ -0,0 +1,87 @@
+"""
+Estadística robusta por grupos para las etapas de funciones.py.
+
+Todas las funciones trabajan sobre el DataFrame completo en una sola pasada
+(posición dentro del grupo y tamaño del grupo), sin un llamado de Python por
+grupo. Los recortes se definen con niveles: lista de (tamaño mínimo, valores
+a quitar por extremo), de mayor a menor; los grupos más chicos que todos los
+mínimos no se recortan. claves=None trata todo el DataFrame como un grupo.
+"""
+import numpy as np
+import pandas as pd
+
+# Ahorros por grupo (TipoProyecto, Servicios, Tipo_Tarifa): n > 20 -> 4, n > 10 -> 2, n > 5 -> 1
+NIVELES_AHORRO = [(21, 4), (11, 2), (6, 1)]
+# Tarifas por (ID_Suministro, Periodo) y semana ideal por cluster: sin mínimo ni máximo si n > 3
+NIVELES_MIN_MAX = [(4, 1)]
+# Guías globales de ahorro: 30 por extremo (NaN con 60 valores o menos)
+NIVELES_GUIA = [(0, 30)]
+# Semana ideal por sitio: primeras y últimas fechas de cada día de la semana
+NIVELES_SEMANA = [(6, 2), (3, 1)]
+
+
+def recorte_por_tamano(tamano, niveles):
+    """Valores a quitar por extremo según el tamaño de cada grupo."""
+    tamano = np.asarray(tamano)
+    recorte = np.zeros(len(tamano), dtype="int64")
+    for minimo, quitar in reversed(niveles):
+        recorte[tamano >= minimo] = quitar
+    return recorte
+
+
+def mascara_recorte(df, claves, niveles):
+    """
+    True para las filas que quedan al quitar las primeras y últimas de cada
+    grupo según su orden en `df`.
+    """
+    grupos = df.groupby(np.zeros(len(df)) if claves is None else claves, sort=False, observed=True)
+    posicion = grupos.cumcount().to_numpy()
+    tamano = posicion + grupos.cumcount(ascending=False).to_numpy() + 1
+    recorte = recorte_por_tamano(tamano, niveles)
+    return pd.Series((posicion >= recorte) & (posicion < tamano - recorte), index=df.index)
+
+
+def recortar_por_posicion(df, claves, niveles):
+    """Equivale a groupby(claves).apply(lambda x: x.iloc[r:-r]) con r según el tamaño."""
+    return df[mascara_recorte(df, claves, niveles)]
+
+
+def recortar_por_valor(df, claves, columna, niveles):
+    """
+    Quita los extremos de `columna` en cada grupo: filas ordenadas por
+    `columna` (orden estable, NaN al final), el tamaño cuenta todas las filas.
+    Equivale a groupby(claves).apply(lambda x: x.sort_values(columna).iloc[r:-r]).
+    """
+    ordenado = df.sort_values(columna, kind="stable", na_position="last")
+    return df[mascara_recorte(ordenado, claves, niveles).reindex(df.index)]
+
+
+def media_recortada(df, claves, columna, niveles):
+    """
+    Media de `columna` por grupo sin sus extremos: se descartan los NaN y,
+    según cuántos valores tenga el grupo, se quitan los menores y los mayores.
+    Devuelve una Series por grupo, o un escalar con claves=None; los grupos
+    que quedan vacíos dan NaN.
+    """
+    valores = pd.to_numeric(df[columna], errors="coerce").dropna()
+    valores = valores.sort_values(kind="stable")
+    claves_valores = None if claves is None else [df.loc[valores.index, c] for c in _lista(claves)]
+    quedan = mascara_recorte(valores.to_frame(), claves_valores, niveles)
+    if claves is None:
+        return valores[quedan].mean()
+    return valores.where(quedan).groupby(claves_valores, observed=True).mean()
+
+
+def limites_media(df, claves, columna, margen, media=None):
+    """
+    Límites [media * (1 - margen), media * (1 + margen)] alrededor de la media
+    del grupo de cada fila (por defecto la media simple de `columna`).
+    Devuelve (media, inferior, superior) alineados con `df`.
+    """
+    if media is None:
+        media = df.groupby(claves, observed=True)[columna].transform("mean")
+    return media, media * (1 - margen), media * (1 + margen)
+
+
+def _lista(claves):
+    return claves if isinstance(claves, list) else [claves]
@@ -1,9 +1,24 @@
 import os
 import re
+import hashlib
+import zlib
+import sqlite3
+import time
+import tracemalloc
 import pandas as pd
 import numpy as np
-from datetime import date
+from openpyxl import load_workbook
+from datetime import date, datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
 import warnings
+import estadisticas as est
+
+try:
+    import pyarrow  # Opcional: habilita la caché columnar de archivos Excel
+except ImportError:
+    pyarrow = None
 
 warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
 pd.set_option('future.no_silent_downcasting', True)
@@ -11,7 +26,986 @@ pd.set_option('future.no_silent_downcasting', True)
 user_profile = os.environ.get("USERPROFILE")
 folder_route = os.path.join(user_profile, "OneDrive","Telefonica PSF","Data") ### modifica con la carpeta de Dalia
 
-def process_files(conn, data_folder, file_type):
+# Caché de lecturas de Excel (Parquet); se desactiva si pyarrow no está instalado
+cache_folder = os.path.join(os.environ.get("LOCALAPPDATA", user_profile), "PSF_cache_excel")
+cache_max_bytes = 2 * 1024**3
+
+COLUMNAS_HORARIAS = {
+    "EnergyConsumption": ["SiteID", "Timestamp", "Consumption"],
+    "TrafficData": ["SiteID", "Timestamp", "TrafficData"]
+}
+
+def _hash_archivo(path, tamano_bloque=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(tamano_bloque), b""):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+def _podar_cache():
+    # Elimina las entradas menos usadas hasta quedar bajo cache_max_bytes
+    entradas = []
+    for nombre in os.listdir(cache_folder):
+        if nombre.endswith(".parquet"):
+            ruta = os.path.join(cache_folder, nombre)
+            stat = os.stat(ruta)
+            entradas.append((stat.st_mtime, stat.st_size, ruta))
+    total = sum(tamano for _, tamano, _ in entradas)
+    for _, tamano, ruta in sorted(entradas):
+        if total <= cache_max_bytes:
+            break
+        try:
+            os.remove(ruta)
+            total -= tamano
+        except OSError:
+            pass
+
+def _leer_con_cache(path, lector, *claves):
+    """
+    Devuelve el DataFrame de lector() pasando por la caché columnar.
+    La clave combina el hash del contenido del archivo con `claves` (hoja,
+    columnas, tipo de normalización), así que un archivo modificado nunca
+    devuelve datos viejos. Si el DataFrame no se puede guardar en Parquet
+    (p.ej. columnas con tipos mezclados) simplemente no se cachea.
+    """
+    if pyarrow is None:
+        return lector()
+
+    clave = hashlib.sha256(repr((_hash_archivo(path),) + claves).encode("utf-8")).hexdigest()
+    ruta = os.path.join(cache_folder, f"{clave}.parquet")
+
+    if os.path.exists(ruta):
+        try:
+            data = pd.read_parquet(ruta, engine="pyarrow")
+            os.utime(ruta)  # marca de uso para la poda
+            return data
+        except Exception:
+            os.remove(ruta)
+
+    data = lector()
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        data.to_parquet(temporal, engine="pyarrow", index=False)
+        os.replace(temporal, ruta)
+        _podar_cache()
+    except Exception:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return data
+
+def leer_excel(path, **kwargs):
+    """pd.read_excel con caché columnar por contenido del archivo."""
+    return _leer_con_cache(path, lambda: pd.read_excel(path, **kwargs), "read_excel", sorted(kwargs.items()))
+
+# Perfiles de conexión SQLite. "carga" para las etapas de escritura masiva;
+# "seguro" restablece la sincronización completa para el commit final.
+PERFILES_SQLITE = {
+    "carga": {
+        "journal_mode": "WAL",         # permite leer la base (p.ej. desde BI) mientras se escribe
+        "synchronous": "NORMAL",       # en WAL no arriesga corrupción, solo durabilidad del último commit
+        "cache_size": -256 * 1024,     # en KiB: 256 MiB de caché de páginas
+        "mmap_size": 1024**3,
+        "temp_store": "MEMORY"
+    },
+    "seguro": {
+        "synchronous": "FULL"
+    }
+}
+
+def aplicar_perfil(conn, perfil):
+    for pragma, valor in PERFILES_SQLITE[perfil].items():
+        conn.execute(f"PRAGMA {pragma} = {valor}")
+
+def conectar(base_route, perfil="carga"):
+    """Abre la base SQLite con el perfil de rendimiento indicado."""
+    conn = sqlite3.connect(base_route)
+    aplicar_perfil(conn, perfil)
+    return conn
+
+@contextmanager
+def transaccion(conn):
+    """
+    Agrupa escrituras en una transacción explícita: commit al terminar,
+    rollback si fallan. Si ya hay una transacción abierta (la de la etapa que
+    llama), el bloque se anida en un SAVEPOINT: un error deshace solo el
+    bloque y el commit queda a cargo de quien abrió la transacción. Así cada
+    etapa de main.py es atómica aunque sus funciones escriban por partes.
+    """
+    if conn.in_transaction:
+        conn.execute("SAVEPOINT transaccion")
+        try:
+            yield conn
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK TO SAVEPOINT transaccion")
+                conn.execute("RELEASE SAVEPOINT transaccion")
+            raise
+        conn.execute("RELEASE SAVEPOINT transaccion")
+        return
+
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def cerrar_conexion(conn):
+    """Commit final con sincronización completa, checkpoint del WAL y cierre."""
+    aplicar_perfil(conn, "seguro")
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+MESES_TRAFICO = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6,
+    "julio": 7, "agosto": 8, "septiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12
+}
+
+def _parsear_fecha_trafico(fechas, horas):
+    """
+    Construye el Timestamp de los archivos de tráfico a partir de la fecha en
+    texto ("5 de noviembre de 2024") y la hora entera. Cada fecha distinta se
+    interpreta una sola vez y la hora se suma como Timedelta, sin armar textos.
+    """
+    codigos, unicas = pd.factorize(fechas)
+    partes = pd.Series(unicas, dtype=object).str.extract(r"(\d+) de (\w+) de (\d+)")
+    dias_unicos = pd.to_datetime(pd.DataFrame({
+        "year": pd.to_numeric(partes[2]),
+        "month": partes[1].map(MESES_TRAFICO),
+        "day": pd.to_numeric(partes[0])
+    }), errors="coerce")
+
+    # El código -1 (fecha vacía) toma el NaT agregado al final
+    dias = np.append(dias_unicos.to_numpy(dtype="datetime64[ns]"), np.datetime64("NaT", "ns"))[codigos]
+    return pd.Series(dias, index=fechas.index) + pd.to_timedelta(np.asarray(horas, dtype="float64"), unit="h")
+
+# Versión de _normalizar_horario/_parsear_fecha_trafico: forma parte de la clave
+# de la caché de archivos horarios (que guarda el resultado normalizado).
+# Subirla al cambiar la normalización para no servir datos con el formato anterior.
+VERSION_NORMALIZACION_HORARIA = 2
+
+def _normalizar_horario(data, file_type):
+    """
+    Renombra columnas, separa el SiteID y construye el Timestamp de un bloque
+    leído de un archivo de energía o de tráfico. Devuelve (data, mensajes).
+    """
+    mensajes = []
+    if file_type == "energy":
+        data.rename(columns={
+            "Site Name": "SiteID",
+            "Start Time": "Timestamp",
+            "Energy Consumption per Hour/kWh": "Consumption"
+        }, inplace=True)
+        selected_columns = ["SiteID", "Timestamp", "Consumption"]
+        data["SiteID"] = data["SiteID"].apply(lambda x: x.split('_')[0])
+
+    else:
+        data.rename(columns={
+            "Unico": "SiteID",
+            "Hora de Fecha": "Hour",
+            "Trafico Datos": "TrafficData"
+        }, inplace=True)
+
+        data["Timestamp"] = _parsear_fecha_trafico(data["Mes, Día, Año de Fecha"], data["Hour"])
+        selected_columns = ["SiteID", "Timestamp", "TrafficData"]
+
+    data = data[selected_columns]
+    if file_type == "energy":
+        data["Timestamp"] = pd.to_datetime(data["Timestamp"])
+
+    return data, mensajes
+
+def _mensajes_fechas(data, file_type):
+    """Rango de fechas de un archivo de tráfico ya normalizado (también si vino de la caché)."""
+    if file_type != "traffic":
+        return []
+    return [f"Fecha menor: {data['Timestamp'].min()}", f"Fecha mayor: {data['Timestamp'].max()}"]
+
+def _leer_archivo_horario(file, file_type):
+    """
+    Lee y normaliza un archivo de energía (NetEco) o de tráfico.
+    Se ejecuta tanto en el proceso principal como en los procesos del pool,
+    por eso debe quedarse a nivel de módulo.
+
+    Devuelve (data, mensajes): data es None si el archivo no pudo leerse.
+    """
+    mensajes = []
+
+    def leer():
+        if file_type == "energy":
+            data = pd.read_excel(file, 
+                                 sheet_name="1 hour", 
+                                 skiprows=5, 
+                                 engine="openpyxl")
+        else:
+            if file.endswith(".xlsx"):
+                data = pd.read_excel(file, 
+                                     sheet_name="Sheet 1", 
+                                     engine="openpyxl")
+            elif file.endswith(".csv"):
+                data = pd.read_csv(file)
+
+        if isinstance(data, dict):
+            mensajes.append("🔍 Warning: El archivo tiene múltiples hojas. Seleccionando la primera disponible.")
+            sheet_names = list(data.keys())
+            mensajes.append(f"Hojas disponibles: {', '.join(sheet_names)}")
+            data = list(data.values())[0]  # Selecciona la primera hoja como DataFrame
+        mensajes.append("Archivo leido")
+
+        data, mensajes_normalizacion = _normalizar_horario(data, file_type)
+        mensajes.extend(mensajes_normalizacion)
+        return data
+
+    try:
+        data = _leer_con_cache(file, leer, "horario", file_type, VERSION_NORMALIZACION_HORARIA)
+    except ValueError:
+        mensajes.append(f"La hoja especificada no se encontró en {file}. Saltando...")
+        return None, mensajes
+
+    if not mensajes:
+        mensajes.append("Archivo leido desde caché")
+    mensajes.extend(_mensajes_fechas(data, file_type))
+
+    # Marco compacto para devolverlo al proceso principal (menos datos serializados)
+    data = data.astype({"SiteID": "category"})
+    return data, mensajes
+
+def _leer_bloques_horario(file, file_type, chunk_size):
+    """
+    Lee un archivo de energía o tráfico por bloques de `chunk_size` filas sin
+    cargar la hoja completa en memoria. Lanza ValueError si la hoja no existe,
+    igual que pd.read_excel.
+    """
+    if file.endswith(".csv"):
+        yield from pd.read_csv(file, chunksize=chunk_size)
+        return
+
+    sheet_name = "1 hour" if file_type == "energy" else "Sheet 1"
+    skiprows = 5 if file_type == "energy" else 0
+
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        if sheet_name not in wb.sheetnames:
+            raise ValueError(f"Worksheet named '{sheet_name}' not found")
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        for _ in range(skiprows):
+            next(rows, None)
+        header = next(rows, None)
+        if header is None:
+            return
+        bloque = []
+        for row in rows:
+            # Filas vacías con formato (p.ej. al final de la hoja): read_excel las omite
+            if all(valor is None for valor in row):
+                continue
+            bloque.append(row)
+            if len(bloque) == chunk_size:
+                yield pd.DataFrame(bloque, columns=header)
+                bloque = []
+        if bloque:
+            yield pd.DataFrame(bloque, columns=header)
+    finally:
+        wb.close()
+
+# Columnas de SiteInfo por las que se puede cortar el cubo de agregados (construir_cubos)
+DIMENSIONES_CUBO = ["Cluster", "Departamento", "Region_Asia", "TipoEstacion", "ProveedorFLM"]
+
+# Catálogo de índices por tabla: (nombre, columnas, único).
+# Reemplazar una tabla borra sus índices, por eso escribir_tabla los recrea
+# con recrear_indices después de cada reescritura.
+INDICES = {
+    "EnergyConsumption": [("ux_EnergyConsumption_SiteID_Timestamp", ["SiteID", "Timestamp"], True)],
+    "TrafficData": [("ux_TrafficData_SiteID_Timestamp", ["SiteID", "Timestamp"], True)],
+    "SiteInfo": [("ix_SiteInfo_SiteID", ["SiteID", "Cluster", "FechaFinSwap"], False)],
+    "SiteStages": [("ix_SiteStages_SiteID", ["SiteID", "FechaInicio", "FechaFin", "Etapa"], False)],
+    "tarifas": [
+        ("ux_tarifas_ID_Suministro_AñoMes", ["ID_Suministro", "AñoMes"], True),
+        ("ix_tarifas_SiteID", ["SiteID"], False)
+    ],
+    "suministros_id": [
+        ("ix_suministros_id_ID_Suministro", ["ID_Suministro"], False),
+        ("ix_suministros_id_SiteID", ["SiteID"], False),
+        ("ix_suministros_id_SUMINISTRO_ACTUAL", ["SUMINISTRO_ACTUAL", "SiteID", "ID_Suministro"], False)
+    ],
+    "ahorro_etapas_sitios": [("ix_ahorro_etapas_sitios_SiteID", ["SiteID", "Etapas_comparadas"], False)],
+    "ahorro_cluster": [("ix_ahorro_cluster_Cluster_Etapa", ["Cluster", "Etapa"], False)],
+    "ahorro_estimado_v2": [
+        ("ix_ahorro_estimado_v2_ID_Suministro_AñoMes", ["ID_Suministro", "AñoMes"], False),
+        ("ix_ahorro_estimado_v2_SiteID", ["SiteID"], False)
+    ],
+    "promedios_por_suministro": [("ix_promedios_por_suministro_ID_Suministro", ["ID_Suministro"], False)],
+    "sitios_clasificados": [("ix_sitios_clasificados_SiteID", ["SiteID"], False)],
+    "AHORRO_PROYECTADO_v2": [
+        ("ix_AHORRO_PROYECTADO_v2_ID_Suministro", ["ID_Suministro"], False),
+        ("ix_AHORRO_PROYECTADO_v2_SiteID", ["SiteID"], False)
+    ],
+    "AHORRO_PROYECTADO_MENSUAL_v2": [("ix_AHORRO_PROYECTADO_MENSUAL_v2_ID_Suministro", ["ID_Suministro", "Mes_Año"], False)],
+    "data": [("ix_data_SiteID", ["SiteID"], False)],
+    "semana_ideal": [("ix_semana_ideal_SiteID", ["SiteID", "Etapa"], False)],
+    "promedio_etapas": [("ix_promedio_etapas_SiteID", ["SiteID", "Etapa"], False)],
+    "semana_ideal_cluster": [("ix_semana_ideal_cluster_Cluster", ["Cluster", "Etapa"], False)],
+    "cubo_semana_ideal": [("ix_cubo_semana_ideal_Etapa", ["Analisis", "Etapa", "DayOfWeek"], False)]
+                         + [(f"ix_cubo_semana_ideal_{d}", [d, "Analisis"], False) for d in DIMENSIONES_CUBO],
+    "cubo_ahorro": [("ix_cubo_ahorro_Etapas_comparadas", ["Analisis", "Etapas_comparadas"], False)]
+                   + [(f"ix_cubo_ahorro_{d}", [d, "Analisis"], False) for d in DIMENSIONES_CUBO]
+}
+
+def recrear_indices(conn, tablas=None):
+    """
+    Crea los índices declarados en INDICES que falten para `tablas` (todas
+    si es None) e imprime el tiempo de cada uno. Omite tablas inexistentes,
+    vistas y columnas ausentes (p.ej. archivos opcionales no cargados).
+    """
+    for tabla in (tablas or INDICES):
+        tipo = conn.execute("SELECT type FROM sqlite_master WHERE name=?", (tabla,)).fetchone()
+        if not tipo or tipo[0] != "table":
+            continue
+        columnas_tabla = {row[1] for row in conn.execute(f'PRAGMA table_info("{tabla}")')}
+
+        for nombre, columnas, unico in INDICES.get(tabla, []):
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (nombre,)).fetchone():
+                continue
+            faltantes = [c for c in columnas if c not in columnas_tabla]
+            if faltantes:
+                print(f"⚠️ Índice '{nombre}' omitido: faltan columnas {', '.join(faltantes)}")
+                continue
+
+            columnas_sql = ", ".join(f'"{c}"' for c in columnas)
+            inicio = time.perf_counter()
+            try:
+                with transaccion(conn):
+                    conn.execute(f'CREATE {"UNIQUE " if unico else ""}INDEX "{nombre}" ON "{tabla}" ({columnas_sql})')
+            except sqlite3.IntegrityError:
+                print(f"⚠️ Índice único '{nombre}' no creado: '{tabla}' tiene duplicados")
+                continue
+            print(f"🗂️ Índice '{nombre}' creado en {time.perf_counter() - inicio:.2f}s")
+
+# Tipos SQLite por tipo inferido de columna (mismo criterio que DataFrame.to_sql)
+TIPOS_SQLITE = {
+    "floating": "REAL", "mixed-integer-float": "REAL", "decimal": "REAL",
+    "integer": "INTEGER", "boolean": "INTEGER",
+    "datetime64": "TIMESTAMP", "datetime": "TIMESTAMP",
+    "date": "DATE", "time": "TIME"
+}
+
+def _tipo_sql(serie):
+    """Tipo SQLite de la columna completa."""
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        serie = serie.cat.categories
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return "TIMESTAMP"
+    if pd.api.types.is_bool_dtype(serie) or pd.api.types.is_integer_dtype(serie):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(serie):
+        return "REAL"
+    return TIPOS_SQLITE.get(pd.api.types.infer_dtype(serie, skipna=True), "TEXT")
+
+def _columna_sql(serie, tipo=None):
+    """
+    Devuelve (tipo SQLite, lista de valores Python con None en faltantes).
+    `tipo`: el ya inferido para la columna completa, al convertirla por bloques.
+    """
+    tipo = tipo or _tipo_sql(serie)
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        serie = serie.astype(serie.cat.categories.dtype)
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return "TIMESTAMP", serie.dt.strftime("%Y-%m-%d %H:%M:%S").where(serie.notna(), None).tolist()
+    valores = serie.astype(object).where(serie.notna(), None)
+    if serie.dtype == object and tipo != "TEXT":
+        # Escalares numpy y fechas dentro de columnas object
+        valores = valores.map(lambda v: v.item() if isinstance(v, np.generic)
+                              else v.isoformat(" ") if isinstance(v, datetime)
+                              else v.isoformat() if isinstance(v, date) else v)
+    elif pd.api.types.is_bool_dtype(serie):
+        valores = valores.map(lambda v: None if v is None else int(v))
+    return tipo, valores.tolist()
+
+# Filas por bloque al convertir entre DataFrames y filas SQLite (acota la memoria)
+FILAS_BLOQUE = 20_000
+
+def _filas_sql(df, tipos):
+    """
+    Tuplas de valores de `df` para executemany, convertidas por bloques de
+    FILAS_BLOQUE filas: la escritura no duplica la tabla entera en
+    objetos Python.
+    """
+    for inicio in range(0, len(df), FILAS_BLOQUE):
+        bloque = df.iloc[inicio:inicio + FILAS_BLOQUE]
+        yield from zip(*(_columna_sql(bloque.iloc[:, i], tipo)[1] for i, tipo in enumerate(tipos)))
+
+def escribir_tabla(conn, df, tabla, tipos=None):
+    """
+    Reemplaza `tabla` con el contenido de `df` (sustituye a to_sql(if_exists="replace")).
+    - Crea la tabla con tipos explícitos (inferidos o forzados con `tipos`).
+    - Carga las filas con executemany sobre tuplas tipadas (convertidas por
+      bloques) en una tabla de staging y la intercambia por la anterior en la
+      misma transacción (la de quien llama, si hay una abierta), así ningún
+      lector ve la tabla a medio escribir.
+    - Recrea los índices del catálogo e informa las filas por segundo.
+    """
+    inicio = time.perf_counter()
+    staging = f"{tabla}__nueva"
+    columnas = [str(c) for c in df.columns]
+    tipos_inferidos = [_tipo_sql(df.iloc[:, i]) for i in range(df.shape[1])]
+    tipos_columnas = [(tipos or {}).get(c, t) for c, t in zip(df.columns, tipos_inferidos)]
+
+    definicion = ", ".join(f'"{c}" {t}' for c, t in zip(columnas, tipos_columnas))
+    marcadores = ", ".join("?" * len(columnas))
+
+    with transaccion(conn):
+        conn.execute(f'DROP TABLE IF EXISTS "{staging}"')
+        conn.execute(f'CREATE TABLE "{staging}" ({definicion})')
+        conn.executemany(f'INSERT INTO "{staging}" VALUES ({marcadores})', _filas_sql(df, tipos_columnas))
+        conn.execute(f'DROP TABLE IF EXISTS "{tabla}"')
+        conn.execute("PRAGMA legacy_alter_table = ON")  # no revalidar vistas ajenas al renombrar
+        conn.execute(f'ALTER TABLE "{staging}" RENAME TO "{tabla}"')
+        conn.execute("PRAGMA legacy_alter_table = OFF")
+
+    duracion = time.perf_counter() - inicio
+    print(f"💾 Tabla '{tabla}': {len(df)} filas en {duracion:.2f}s ({len(df) / max(duracion, 1e-9):,.0f} filas/s)")
+    recrear_indices(conn, [tabla])
+
+def reemplazar_filas(conn, df, tabla, columna, valores):
+    """
+    Reemplaza en `tabla` las filas cuyo `columna` está en `valores` por las de
+    `df` (escritura parcial; la tabla debe existir). Las columnas nuevas de
+    `df` se agregan a la tabla. Todo en una transacción (anidada en la de
+    quien llama, si hay una abierta).
+    """
+    inicio = time.perf_counter()
+    columnas_tabla = {row[1] for row in conn.execute(f'PRAGMA table_info("{tabla}")')}
+    columnas = [str(c) for c in df.columns]
+    tipos_columnas = [_tipo_sql(df.iloc[:, i]) for i in range(df.shape[1])]
+
+    with transaccion(conn):
+        for c, tipo in zip(columnas, tipos_columnas):
+            if c not in columnas_tabla:
+                conn.execute(f'ALTER TABLE "{tabla}" ADD COLUMN "{c}" {tipo}')
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS _claves_reemplazo (Valor PRIMARY KEY)")
+        conn.execute("DELETE FROM _claves_reemplazo")
+        conn.executemany("INSERT OR IGNORE INTO _claves_reemplazo VALUES (?)", ((v,) for v in valores))
+        borradas = conn.execute(f'DELETE FROM "{tabla}" WHERE "{columna}" IN (SELECT Valor FROM _claves_reemplazo)').rowcount
+        columnas_sql = ", ".join(f'"{c}"' for c in columnas)
+        conn.executemany(f'INSERT INTO "{tabla}" ({columnas_sql}) VALUES ({", ".join("?" * len(columnas))})', _filas_sql(df, tipos_columnas))
+
+    duracion = time.perf_counter() - inicio
+    print(f"💾 Tabla '{tabla}': {borradas} filas reemplazadas por {len(df)} en {duracion:.2f}s ({len(valores)} valores de {columna})")
+
+def _existe_tabla(conn, tabla):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (tabla,)).fetchone() is not None
+
+# Procesos que recalculan por sitio: "consumo" (data, semana_ideal, promedio_etapas)
+# y "cluster" (semana_ideal_cluster, ahorro_etapas_sitios, ahorro_cluster)
+PROCESOS_PENDIENTES = ("consumo", "cluster")
+
+def asegurar_pendientes(conn):
+    """
+    Crea el registro de sitios con datos nuevos desde la última ejecución de
+    cada proceso (sitios_pendientes) y de clusters que perdieron sitios
+    (clusters_pendientes).
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sitios_pendientes (
+            Proceso TEXT NOT NULL,
+            SiteID TEXT NOT NULL,
+            PRIMARY KEY (Proceso, SiteID)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE TABLE IF NOT EXISTS clusters_pendientes (Cluster TEXT PRIMARY KEY)")
+
+def marcar_pendientes(conn, sitios, procesos=PROCESOS_PENDIENTES):
+    """
+    Marca sitios para recalcular en `procesos`. `sitios` es un iterable de
+    SiteID o una consulta SQL que devuelve una columna SiteID. No hace commit.
+    """
+    asegurar_pendientes(conn)
+    for proceso in procesos:
+        if isinstance(sitios, str):
+            conn.execute(f"INSERT OR IGNORE INTO sitios_pendientes (Proceso, SiteID) SELECT ?, SiteID FROM ({sitios}) WHERE SiteID IS NOT NULL", (proceso,))
+        else:
+            conn.executemany("INSERT OR IGNORE INTO sitios_pendientes (Proceso, SiteID) VALUES (?, ?)", ((proceso, str(s)) for s in sitios if pd.notna(s)))
+
+def leer_pendientes(conn, proceso):
+    asegurar_pendientes(conn)
+    return [row[0] for row in conn.execute("SELECT SiteID FROM sitios_pendientes WHERE Proceso = ? ORDER BY SiteID", (proceso,))]
+
+def limpiar_pendientes(conn, proceso, sitios=None):
+    """Quita los sitios ya recalculados (todos con sitios=None). No hace commit."""
+    asegurar_pendientes(conn)
+    if sitios is None:
+        conn.execute("DELETE FROM sitios_pendientes WHERE Proceso = ?", (proceso,))
+    else:
+        conn.executemany("DELETE FROM sitios_pendientes WHERE Proceso = ? AND SiteID = ?", ((proceso, s) for s in sitios))
+
+def _sitios_calculo(conn, sitios):
+    """Carga `sitios` en la tabla temporal _sitios_calculo para filtrar consultas."""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _sitios_calculo (SiteID TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM _sitios_calculo")
+    conn.executemany("INSERT OR IGNORE INTO _sitios_calculo VALUES (?)", ((s,) for s in sitios))
+
+def asegurar_clave_horaria(conn, table_name):
+    """
+    Garantiza que la tabla horaria tenga una clave única (SiteID, Timestamp).
+    - Si la tabla no existe, la crea con el mismo esquema que DataFrame.to_sql.
+    - Si existe sin la clave (bases antiguas), hace la migración única:
+      elimina duplicados conservando la primera fila cargada y crea el índice.
+    """
+    if es_esquema_compacto(conn, table_name):
+        return  # La clave primaria de la tabla compacta ya es (SiteKey, Hora)
+
+    columna_valor = COLUMNAS_HORARIAS[table_name][2]
+    indice = f"ux_{table_name}_SiteID_Timestamp"
+
+    existe = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()
+    if not existe:
+        print(f"La tabla '{table_name}' no existe. Creándola...")
+        with transaccion(conn):
+            conn.execute(f'CREATE TABLE "{table_name}" ("SiteID" TEXT, "Timestamp" TIMESTAMP, "{columna_valor}" REAL)')
+            conn.execute(f'CREATE UNIQUE INDEX "{indice}" ON "{table_name}" ("SiteID", "Timestamp")')
+        print(f"Tabla '{table_name}' creada exitosamente.")
+        return
+
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (indice,)).fetchone():
+        return
+
+    print(f"🔧 Migrando '{table_name}': creando clave única (SiteID, Timestamp)...")
+    with transaccion(conn):
+        cursor = conn.execute(f"""
+            DELETE FROM "{table_name}"
+            WHERE rowid NOT IN (
+                SELECT MIN(rowid) FROM "{table_name}" GROUP BY SiteID, Timestamp
+            )
+        """)
+        conn.execute(f'DROP INDEX IF EXISTS "ix_{table_name}_SiteID_Timestamp"')
+        conn.execute(f'CREATE UNIQUE INDEX "{indice}" ON "{table_name}" ("SiteID", "Timestamp")')
+    print(f"✅ Migración completada. {cursor.rowcount} registros duplicados eliminados.")
+
+def es_esquema_compacto(conn, table_name):
+    # En el esquema compacto la tabla horaria es una vista sobre {table_name}_compacta
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='view' AND name=?", (table_name,)).fetchone() is not None
+
+def migrar_esquema_compacto(conn):
+    """
+    Pasa EnergyConsumption y TrafficData al esquema compacto (opcional):
+    - Sitios: diccionario SiteID -> SiteKey entero.
+    - {tabla}_compacta: (SiteKey, Hora, valor) con Hora en horas desde epoch,
+      clave primaria (SiteKey, Hora) y WITHOUT ROWID (datos agrupados por sitio).
+    - Vista {tabla} con las columnas de siempre (SiteID, Timestamp, valor),
+      para que las consultas existentes sigan funcionando.
+    Es idempotente; las filas sin SiteID o Timestamp no se migran.
+    """
+    with transaccion(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS Sitios (SiteKey INTEGER PRIMARY KEY, SiteID TEXT NOT NULL UNIQUE)")
+
+    migradas = 0
+    for table_name, (_, _, columna_valor) in COLUMNAS_HORARIAS.items():
+        if es_esquema_compacto(conn, table_name):
+            continue
+
+        print(f"🔧 Migrando '{table_name}' al esquema compacto...")
+        compacta = f"{table_name}_compacta"
+        existe = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()
+        with transaccion(conn):
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS "{compacta}" (
+                    SiteKey INTEGER NOT NULL,
+                    Hora INTEGER NOT NULL,
+                    "{columna_valor}" REAL,
+                    PRIMARY KEY (SiteKey, Hora)
+                ) WITHOUT ROWID
+            """)
+            if existe:
+                conn.execute(f'INSERT OR IGNORE INTO Sitios (SiteID) SELECT DISTINCT SiteID FROM "{table_name}" WHERE SiteID IS NOT NULL')
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO "{compacta}" (SiteKey, Hora, "{columna_valor}")
+                    SELECT s.SiteKey, CAST(strftime('%s', t.Timestamp) AS INTEGER) / 3600, t."{columna_valor}"
+                    FROM "{table_name}" AS t
+                    JOIN Sitios AS s ON s.SiteID = t.SiteID
+                    WHERE t.Timestamp IS NOT NULL
+                    ORDER BY s.SiteKey, t.Timestamp
+                """)
+                conn.execute(f'DROP TABLE "{table_name}"')
+                migradas += 1
+            conn.execute(f"""
+                CREATE VIEW "{table_name}" AS
+                SELECT s.SiteID AS SiteID,
+                       datetime(c.Hora * 3600, 'unixepoch') AS Timestamp,
+                       c."{columna_valor}" AS "{columna_valor}"
+                FROM "{compacta}" AS c
+                JOIN Sitios AS s ON s.SiteKey = c.SiteKey
+            """)
+        total = conn.execute(f'SELECT COUNT(*) FROM "{compacta}"').fetchone()[0]
+        print(f"✅ '{table_name}' en esquema compacto. Registros: {total}")
+
+    if migradas and not conn.in_transaction:
+        # Recupera el espacio de las tablas de texto eliminadas (VACUUM no
+        # puede correr dentro de una transacción)
+        conn.execute("VACUUM")
+
+def _insertar_horario_compacto(conn, table_name, data, actualizar):
+    columna_valor = COLUMNAS_HORARIAS[table_name][2]
+    compacta = f"{table_name}_compacta"
+    data = data.dropna(subset=["SiteID", "Timestamp"])
+    site_ids = data["SiteID"].astype(str)
+
+    conn.executemany("INSERT OR IGNORE INTO Sitios (SiteID) VALUES (?)", ((site_id,) for site_id in site_ids.unique()))
+    claves = dict(conn.execute("SELECT SiteID, SiteKey FROM Sitios"))
+
+    site_keys = site_ids.map(claves).astype("int64").tolist()
+    horas = data["Timestamp"].to_numpy(dtype="datetime64[h]").astype("int64").tolist()
+    valores = data[columna_valor].astype(object).where(data[columna_valor].notna(), None).tolist()
+
+    if actualizar:
+        sentencia = f"""
+            INSERT INTO "{compacta}" (SiteKey, Hora, "{columna_valor}") VALUES (?, ?, ?)
+            ON CONFLICT (SiteKey, Hora) DO UPDATE SET "{columna_valor}" = excluded."{columna_valor}"
+        """
+    else:
+        sentencia = f'INSERT OR IGNORE INTO "{compacta}" (SiteKey, Hora, "{columna_valor}") VALUES (?, ?, ?)'
+
+    cambios_previos = conn.total_changes
+    conn.executemany(sentencia, zip(site_keys, horas, valores))
+    return conn.total_changes - cambios_previos
+
+def _insertar_horario(conn, table_name, data, actualizar=False):
+    """
+    Inserta filas en una tabla horaria con semántica insert-or-ignore sobre la
+    clave (SiteID, Timestamp); con actualizar=True las filas existentes toman
+    el valor nuevo (upsert). Recalcula el resumen diario de los días tocados.
+    No hace commit. Devuelve las filas escritas.
+    """
+    if es_esquema_compacto(conn, table_name):
+        escritos = _insertar_horario_compacto(conn, table_name, data, actualizar)
+    else:
+        escritos = _insertar_horario_texto(conn, table_name, data, actualizar)
+
+    if escritos:
+        actualizar_resumen_diario(conn, table_name, data)
+    return escritos
+
+def _insertar_horario_texto(conn, table_name, data, actualizar):
+    columnas = COLUMNAS_HORARIAS[table_name]
+    data = data[columnas].copy()
+    data["Timestamp"] = data["Timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    filas = data.astype(object).where(data.notna(), None).itertuples(index=False, name=None)
+
+    if actualizar:
+        sentencia = f"""
+            INSERT INTO "{table_name}" ({", ".join(columnas)}) VALUES (?, ?, ?)
+            ON CONFLICT (SiteID, Timestamp) DO UPDATE SET "{columnas[2]}" = excluded."{columnas[2]}"
+        """
+    else:
+        sentencia = f'INSERT OR IGNORE INTO "{table_name}" ({", ".join(columnas)}) VALUES (?, ?, ?)'
+
+    cambios_previos = conn.total_changes
+    conn.executemany(sentencia, filas)
+    return conn.total_changes - cambios_previos
+
+# Ventanas horarias de análisis: (Analisis, HoraInicio, HoraFin, Multiplicador).
+# El multiplicador lleva el promedio horario al total de la ventana. Con
+# HoraInicio > HoraFin la ventana cruza la medianoche (p.ej. 22 a 6): cuenta
+# las horas >= HoraInicio y <= HoraFin del mismo día calendario.
+VENTANAS_ANALISIS = [
+    ("24h", 0, 23, 24),
+    ("Nocturno", 0, 6, 6),
+]
+# Ventana con la que se marcan en SiteInfo las etapas presentes de cada sitio
+VENTANA_REFERENCIA = "24h"
+
+def leer_ventanas(conn):
+    """Ventanas de ventanas_analisis en su orden de definición (VENTANAS_ANALISIS si aún no existe)."""
+    if not _existe_tabla(conn, "ventanas_analisis"):
+        return [ventana[0] for ventana in VENTANAS_ANALISIS]
+    return [row[0] for row in conn.execute("SELECT Analisis FROM ventanas_analisis ORDER BY rowid")]
+
+def ventana_referencia(ventanas):
+    """VENTANA_REFERENCIA si está entre `ventanas`; si no, la primera (con aviso)."""
+    if VENTANA_REFERENCIA in ventanas or not ventanas:
+        return VENTANA_REFERENCIA
+    print(f"⚠️ La ventana de referencia '{VENTANA_REFERENCIA}' no está en ventanas_analisis; se usa '{ventanas[0]}'")
+    return ventanas[0]
+
+def asegurar_resumen_diario(conn):
+    """
+    Crea el resumen diario materializado y lo mantiene coherente con las ventanas:
+    - ventanas_analisis: ventanas horarias (se siembra con VENTANAS_ANALISIS).
+    - resumen_diario: una fila por (SiteID, Fecha, Analisis) con el promedio
+      horario y la cantidad de horas con dato de consumo y de tráfico.
+    - resumen_diario_ventanas: definición de ventanas con la que se construyó;
+      si una ventana es nueva o cambió sus horas, se reconstruye completa.
+    """
+    existe = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='resumen_diario'").fetchone()
+    with transaccion(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ventanas_analisis (
+                Analisis TEXT PRIMARY KEY,
+                HoraInicio INTEGER NOT NULL,
+                HoraFin INTEGER NOT NULL,
+                Multiplicador REAL NOT NULL
+            )
+        """)
+        conn.executemany("INSERT OR IGNORE INTO ventanas_analisis VALUES (?, ?, ?, ?)", VENTANAS_ANALISIS)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS resumen_diario (
+                SiteID TEXT NOT NULL,
+                Fecha TEXT NOT NULL,
+                Analisis TEXT NOT NULL,
+                Consumption REAL,
+                HorasConsumption INTEGER,
+                TrafficData REAL,
+                HorasTrafficData INTEGER,
+                PRIMARY KEY (SiteID, Fecha, Analisis)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS resumen_diario_ventanas (Analisis TEXT PRIMARY KEY, HoraInicio INTEGER, HoraFin INTEGER)")
+        if not existe:
+            conn.execute("DELETE FROM resumen_diario_ventanas")
+
+    actuales = set(conn.execute("SELECT Analisis, HoraInicio, HoraFin FROM ventanas_analisis"))
+    construidas = set(conn.execute("SELECT Analisis, HoraInicio, HoraFin FROM resumen_diario_ventanas"))
+    if actuales == construidas:
+        return
+
+    reconstruir = sorted({ventana[0] for ventana in actuales - construidas})
+    quitar = {ventana[0] for ventana in construidas - actuales}
+    print(f"🔧 Reconstruyendo resumen diario para ventanas: {', '.join(reconstruir) or '-'}")
+    with transaccion(conn):
+        conn.executemany("DELETE FROM resumen_diario WHERE Analisis = ?", ((analisis,) for analisis in quitar | set(reconstruir)))
+        for table_name in COLUMNAS_HORARIAS:
+            existe = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table_name,)).fetchone()
+            if existe and reconstruir:
+                _agregar_resumen_diario(conn, table_name, ventanas=reconstruir)
+        conn.execute("DELETE FROM resumen_diario_ventanas")
+        conn.execute("INSERT INTO resumen_diario_ventanas SELECT Analisis, HoraInicio, HoraFin FROM ventanas_analisis")
+        marcar_pendientes(conn, "SELECT DISTINCT SiteID FROM resumen_diario")
+    total = conn.execute("SELECT COUNT(*) FROM resumen_diario").fetchone()[0]
+    print(f"✅ Resumen diario listo. Registros: {total}")
+
+def _agregar_resumen_diario(conn, table_name, ventanas=None, por_dias=False):
+    """
+    Agrega la tabla horaria a (SiteID, Fecha, Analisis) y hace upsert de sus
+    columnas en resumen_diario. Con por_dias=True solo recorre los días de
+    la tabla temporal _dias_resumen (usa la clave de la tabla horaria).
+    """
+    columna_valor = COLUMNAS_HORARIAS[table_name][2]
+    if es_esquema_compacto(conn, table_name):
+        origen = f'"{table_name}_compacta" AS t JOIN Sitios AS s ON s.SiteKey = t.SiteKey'
+        sitio, fecha, hora = "s.SiteID", "date(t.Hora * 3600, 'unixepoch')", "t.Hora % 24"
+        filtro_dias = """JOIN _dias_resumen AS d ON s.SiteID = d.SiteID
+            AND t.Hora >= CAST(strftime('%s', d.Fecha) AS INTEGER) / 3600
+            AND t.Hora < CAST(strftime('%s', d.Fecha) AS INTEGER) / 3600 + 24"""
+    else:
+        origen = f'"{table_name}" AS t'
+        sitio, fecha, hora = "t.SiteID", "date(t.Timestamp)", "CAST(strftime('%H', t.Timestamp) AS INTEGER)"
+        filtro_dias = """JOIN _dias_resumen AS d ON t.SiteID = d.SiteID
+            AND t.Timestamp >= d.Fecha AND t.Timestamp < date(d.Fecha, '+1 day')"""
+
+    condiciones = [f"{sitio} IS NOT NULL", f"{fecha} IS NOT NULL"]
+    parametros = []
+    if ventanas is not None:
+        condiciones.append(f"v.Analisis IN ({', '.join('?' * len(ventanas))})")
+        parametros.extend(ventanas)
+
+    conn.execute(f"""
+        INSERT INTO resumen_diario (SiteID, Fecha, Analisis, "{columna_valor}", "Horas{columna_valor}")
+        SELECT {sitio}, {fecha}, v.Analisis, AVG(t."{columna_valor}"), COUNT(t."{columna_valor}")
+        FROM {origen}
+        {filtro_dias if por_dias else ""}
+        JOIN ventanas_analisis AS v ON CASE
+            WHEN v.HoraInicio <= v.HoraFin THEN {hora} BETWEEN v.HoraInicio AND v.HoraFin
+            ELSE {hora} >= v.HoraInicio OR {hora} <= v.HoraFin
+        END
+        WHERE {" AND ".join(condiciones)}
+        GROUP BY {sitio}, {fecha}, v.Analisis
+        ON CONFLICT (SiteID, Fecha, Analisis) DO UPDATE SET
+            "{columna_valor}" = excluded."{columna_valor}",
+            "Horas{columna_valor}" = excluded."Horas{columna_valor}"
+    """, parametros)
+
+def actualizar_resumen_diario(conn, table_name, data):
+    """
+    Recalcula en resumen_diario solo los (SiteID, día) presentes en `data`
+    (filas horarias recién cargadas). No hace commit.
+    """
+    dias = pd.DataFrame({
+        "SiteID": data["SiteID"].astype(object),
+        "Fecha": data["Timestamp"].dt.strftime("%Y-%m-%d")
+    }).dropna().drop_duplicates()
+
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _dias_resumen (SiteID TEXT, Fecha TEXT, PRIMARY KEY (SiteID, Fecha))")
+    conn.execute("DELETE FROM _dias_resumen")
+    conn.executemany("INSERT INTO _dias_resumen VALUES (?, ?)", dias.itertuples(index=False, name=None))
+    _agregar_resumen_diario(conn, table_name, por_dias=True)
+    marcar_pendientes(conn, "SELECT DISTINCT SiteID FROM _dias_resumen")
+
+def asegurar_registro_ingesta(conn):
+    """
+    Crea el registro de ingesta: una fila por archivo de entrada ya cargado,
+    con su tamaño, fecha de modificación, hash de contenido y filas cargadas.
+    Reemplaza el esquema anterior de renombrar archivos a old/*_procesado.
+    """
+    with transaccion(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ingesta_archivos (
+                Ruta TEXT PRIMARY KEY,
+                Tipo TEXT,
+                Tamano INTEGER,
+                Mtime REAL,
+                Hash TEXT,
+                Filas INTEGER,
+                FechaCarga TEXT
+            )
+        """)
+
+def archivos_pendientes(conn, files, tipo):
+    """
+    Filtra `files` contra el registro de ingesta y devuelve solo los que hay
+    que cargar, como dicts con Ruta, Tipo, Tamano, Mtime, Hash y Estado
+    ("nuevo" o "modificado"). El hash solo se calcula si cambió el tamaño o
+    la fecha de modificación respecto al registro.
+    """
+    asegurar_registro_ingesta(conn)
+    registrados = {
+        ruta: (tamano, mtime, hash_)
+        for ruta, tamano, mtime, hash_ in conn.execute("SELECT Ruta, Tamano, Mtime, Hash FROM ingesta_archivos WHERE Tipo = ?", (tipo,))
+    }
+
+    pendientes = []
+    for file in files:
+        ruta = os.path.abspath(file)
+        stat = os.stat(ruta)
+        previo = registrados.get(ruta)
+        if previo and previo[0] == stat.st_size and previo[1] == stat.st_mtime:
+            continue
+
+        hash_ = _hash_archivo(ruta)
+        if previo and previo[2] == hash_:
+            # Mismo contenido (p.ej. copiado de nuevo): solo se actualiza la huella
+            with transaccion(conn):
+                conn.execute("UPDATE ingesta_archivos SET Tamano = ?, Mtime = ? WHERE Ruta = ?", (stat.st_size, stat.st_mtime, ruta))
+            continue
+
+        pendientes.append({
+            "Ruta": ruta,
+            "Tipo": tipo,
+            "Tamano": stat.st_size,
+            "Mtime": stat.st_mtime,
+            "Hash": hash_,
+            "Estado": "modificado" if previo else "nuevo"
+        })
+    return pendientes
+
+def registrar_ingesta(conn, archivo, filas):
+    """Anota un archivo como cargado. No hace commit."""
+    conn.execute(
+        "INSERT OR REPLACE INTO ingesta_archivos (Ruta, Tipo, Tamano, Mtime, Hash, Filas, FechaCarga) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (archivo["Ruta"], archivo["Tipo"], archivo["Tamano"], archivo["Mtime"], archivo["Hash"], int(filas),
+         pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S"))
+    )
+
+def olvidar_ingesta(conn, tipo=None, carpeta=None, desde=None, hasta=None):
+    """
+    Quita archivos del registro de ingesta para forzar su reproceso en la
+    próxima ejecución. Filtros opcionales: tipo ("energy", "traffic",
+    "tarifas"), carpeta (prefijo de la ruta) y rango de fecha de
+    modificación del archivo [desde, hasta]. Devuelve los archivos quitados.
+    """
+    asegurar_registro_ingesta(conn)
+    condiciones, parametros = [], []
+    if tipo:
+        condiciones.append("Tipo = ?")
+        parametros.append(tipo)
+    if carpeta:
+        # Comparación literal del prefijo: con LIKE, "_" y "%" de la ruta serían comodines
+        prefijo = os.path.join(os.path.abspath(carpeta), "")
+        condiciones.append("substr(Ruta, 1, ?) = ?")
+        parametros.extend([len(prefijo), prefijo])
+    if desde:
+        condiciones.append("Mtime >= ?")
+        parametros.append(pd.Timestamp(desde).timestamp())
+    if hasta:
+        condiciones.append("Mtime < ?")
+        parametros.append((pd.Timestamp(hasta) + pd.Timedelta(days=1)).timestamp())
+
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    with transaccion(conn):
+        cursor = conn.execute(f"DELETE FROM ingesta_archivos {where}", parametros)
+    return cursor.rowcount
+
+def _cargar_bloques(conn, archivos, file_type, table_name, chunk_size):
+    """
+    Modo streaming de process_files: cada bloque se normaliza y se inserta en
+    su propia transacción (llamar fuera de una transacción de etapa); los (SiteID, Timestamp) ya cargados se ignoran,
+    salvo en archivos modificados, cuyos valores reemplazan a los anteriores.
+    La memoria depende de `chunk_size`, no de la cantidad de archivos.
+    Devuelve (insertados, duplicados).
+    """
+    if conn.in_transaction:
+        print("⚠️ Carga en streaming dentro de una transacción abierta: los bloques se confirmarán recién al cerrarla")
+    insertados = 0
+    duplicados = 0
+    i=1
+    for archivo in archivos:
+        file = archivo["Ruta"]
+        actualizar = archivo["Estado"] == "modificado"
+        print(f"Procesando archivo [{i}/{len(archivos)}]: {file}")
+        filas_archivo = 0
+        try:
+            for bloque in _leer_bloques_horario(file, file_type, chunk_size):
+                bloque, mensajes = _normalizar_horario(bloque, file_type)
+                for mensaje in mensajes + _mensajes_fechas(bloque, file_type):
+                    print(mensaje)
+                with transaccion(conn):
+                    nuevos = _insertar_horario(conn, table_name, bloque, actualizar)
+                insertados += nuevos
+                duplicados += len(bloque) - nuevos
+                filas_archivo += len(bloque)
+            print("Archivo leido")
+        except ValueError:
+            if filas_archivo:
+                # Falló a mitad de archivo: sin registrar, se reintenta completo
+                print(f"Error al leer {file} después de {filas_archivo} filas. Saltando...")
+                continue
+            # Sin la hoja esperada: se registra con 0 filas para no releerlo en
+            # cada ejecución (se vuelve a intentar si el archivo cambia)
+            print(f"La hoja especificada no se encontró en {file}. Saltando...")
+        finally:
+            i+=1
+        with transaccion(conn):
+            registrar_ingesta(conn, archivo, filas_archivo)
+
+    return insertados, duplicados
+
+def _resumen_tabla_horaria(conn, table_name):
+    total_records = pd.read_sql_query(f"SELECT COUNT(*) AS total FROM {table_name}", conn)
+    site_count = pd.read_sql_query(f"SELECT COUNT(DISTINCT SiteID) AS site_count FROM {table_name}", conn)
+    date_range = pd.read_sql_query(f"""
+        SELECT MIN(Timestamp) AS start_date, 
+               MAX(Timestamp) AS end_date 
+        FROM {table_name}
+    """, conn)
+    
+    print(f"Registros en la tabla '{table_name}': {total_records['total'][0]}")
+    print(f"Sitios únicos: {site_count['site_count'][0]}")
+    print(f"Información desde {date_range['start_date'][0]} hasta {date_range['end_date'][0]}")
+
+def process_files(conn, data_folder, file_type, workers=1, chunk_size=None):
+    """
+    Carga los archivos horarios de energía o tráfico en su tabla.
+    - workers > 1: cada archivo se lee y normaliza en un pool de procesos;
+      el proceso principal solo une los resultados y los carga en SQLite.
+    - chunk_size: modo streaming, lee e inserta por bloques de ese número de
+      filas en transacciones separadas (memoria acotada para cargas grandes).
+    Los archivos ya cargados se omiten según el registro de ingesta
+    (ingesta_archivos); los modificados se vuelven a cargar.
+    """
+
+    if file_type not in ("energy", "traffic"):
+        print("Tipo de archivo no reconocido. Usar 'energy' o 'traffic'.")
+        return
 
     table_name = "EnergyConsumption" if file_type == "energy" else "TrafficData"
 
@@ -22,125 +1016,75 @@ def process_files(conn, data_folder, file_type):
         else:
             files.extend([os.path.join(root, f) for f in filenames if (f.endswith(".xlsx") or f.endswith(".csv")) and "_procesado" not in f])
     
-    if not files:
+    # Solo archivos nuevos o modificados según el registro de ingesta
+    archivos = archivos_pendientes(conn, files, file_type)
+
+    if not archivos:
         print(f"No hay archivos nuevos para procesar de tipo {file_type}.")
-        total_records = pd.read_sql_query(f"SELECT COUNT(*) AS total FROM {table_name}", conn)
-        site_count = pd.read_sql_query(f"SELECT COUNT(DISTINCT SiteID) AS site_count FROM {table_name}", conn)
-        date_range = pd.read_sql_query(f"""
-            SELECT MIN(Timestamp) AS start_date, 
-                   MAX(Timestamp) AS end_date 
-            FROM {table_name}
-        """, conn)
-        
-        print(f"Registros en la tabla '{table_name}': {total_records['total'][0]}")
-        print(f"Sitios únicos: {site_count['site_count'][0]}")
-        print(f"Información desde {date_range['start_date'][0]} hasta {date_range['end_date'][0]}")
+        _resumen_tabla_horaria(conn, table_name)
         return
     
-    consolidated_data = []
+    files = [archivo["Ruta"] for archivo in archivos]
     print(f"Los archivos son: {files}")
-    i=1
 
-    for file in files:
-        print(f"Procesando archivo [{i}/{len(files)}]: {file}")
-        
-        try:
-            if file_type == "energy":
-                data = pd.read_excel(file, 
-                                     sheet_name="1 hour", 
-                                     skiprows=5, 
-                                     engine="openpyxl")
-            else:
-                if file.endswith(".xlsx"):
-                    data = pd.read_excel(file, 
-                                         sheet_name="Sheet 1", 
-                                         engine="openpyxl")
-                elif file.endswith(".csv"):
-                    data = pd.read_csv(file)
-
-            if isinstance(data, dict):
-                print("🔍 Warning: El archivo tiene múltiples hojas. Seleccionando la primera disponible.")
-                sheet_names = list(data.keys())
-                print(f"Hojas disponibles: {', '.join(sheet_names)}")
-                data = list(data.values())[0]  # Selecciona la primera hoja como DataFrame
-            print("Archivo leido")
+    asegurar_clave_horaria(conn, table_name)
+    asegurar_resumen_diario(conn)
 
-        except ValueError:
-            print(f"La hoja especificada no se encontró en {file}. Saltando...")
-            continue
-        
-        if file_type == "energy":
-            data.rename(columns={
-                "Site Name": "SiteID",
-                "Start Time": "Timestamp",
-                "Energy Consumption per Hour/kWh": "Consumption"
-            }, inplace=True)
-            selected_columns = ["SiteID", "Timestamp", "Consumption"]
-            data["SiteID"] = data["SiteID"].apply(lambda x: x.split('_')[0])
-
-        elif file_type == "traffic":
-            meses = {
-                "enero": "01", "febrero": "02", "marzo": "03", "abril": "04", "mayo": "05", "junio": "06",
-                "julio": "07", "agosto": "08", "septiembre": "09", "octubre": "10", "noviembre": "11", "diciembre": "12"
-            }
-
-            # Extraer el día, el mes en texto y el año
-            data[['Día', 'MesTexto', 'Año']] = data["Mes, Día, Año de Fecha"].str.extract(r"(\d+) de (\w+) de (\d+)")
-            data["Mes"] = data["MesTexto"].map(meses)
-            data["Date"] = data["Día"] + "-" + data["Mes"] + "-" + data["Año"]
-            data["Date"] = pd.to_datetime(data["Date"], format="%d-%m-%Y")
-
-            data.rename(columns={
-                "Unico": "SiteID",
-                "Hora de Fecha": "Hour",
-                "Trafico Datos": "TrafficData"
-            }, inplace=True)
-
-            data["Timestamp"] = pd.to_datetime(data["Date"].astype(str) + " " + data["Hour"].astype(str) + ":00:00")
-            selected_columns = ["SiteID", "Timestamp", "TrafficData"]
+    if chunk_size:
+        print(f"Cargando en modo streaming (bloques de {chunk_size} filas)...")
+        insertados, duplicados = _cargar_bloques(conn, archivos, file_type, table_name, chunk_size)
+    else:
+        nuevos = []
+        modificados = []
+        leidos = []
+
+        if workers > 1:
+            print(f"Leyendo {len(files)} archivos con {workers} procesos...")
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                resultados = executor.map(_leer_archivo_horario, files, repeat(file_type))
+                resultados = list(resultados)
         else:
-            print("Tipo de archivo no reconocido. Usar 'energy' o 'traffic'.")
+            resultados = (_leer_archivo_horario(file, file_type) for file in files)
+
+        for i, (archivo, (data, mensajes)) in enumerate(zip(archivos, resultados), start=1):
+            print(f"Procesando archivo [{i}/{len(files)}]: {archivo['Ruta']}")
+            for mensaje in mensajes:
+                print(mensaje)
+            if data is None:
+                # Sin la hoja esperada: se registra con 0 filas para no releerlo en
+                # cada ejecución (se vuelve a intentar si el archivo cambia)
+                leidos.append((archivo, 0))
+                continue
+            (modificados if archivo["Estado"] == "modificado" else nuevos).append(data)
+            leidos.append((archivo, len(data)))
+
+        if not nuevos and not modificados:
+            with transaccion(conn):
+                for archivo, filas in leidos:
+                    registrar_ingesta(conn, archivo, filas)
+            print(f"No se encontraron datos válidos para procesar de tipo {file_type}.")
             return
-        
-        data = data[selected_columns]
-        if file_type == "traffic":
-            data["Timestamp"] = pd.to_datetime(data["Timestamp"], dayfirst=True)
-            print(f"Fecha menor: {data['Timestamp'].min()}")
-            print(f"Fecha mayor: {data['Timestamp'].max()}")
 
-        else:
-            data["Timestamp"] = pd.to_datetime(data["Timestamp"])
-        consolidated_data.append(data)
-        i+=1
-    
-    if not consolidated_data:
-        print(f"No se encontraron datos válidos para procesar de tipo {file_type}.")
-        return
-    
-    consolidated_data = pd.concat(consolidated_data, ignore_index=True).drop_duplicates(subset=["SiteID", "Timestamp"])
-    
-    table_exists_query = f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';"
-    table_exists = pd.read_sql_query(table_exists_query, conn)
-
-    if table_exists.empty:
-        print(f"La tabla '{table_name}' no existe. Creándola...")
-        consolidated_data.to_sql(table_name, conn, if_exists="replace", index=False)
-        print(f"Tabla '{table_name}' creada exitosamente.")
-
-    existing_data_query = f"SELECT SiteID, Timestamp FROM {table_name}"
-    existing_data = pd.read_sql_query(existing_data_query, conn)
-    
-    existing_data["Timestamp"] = pd.to_datetime(existing_data["Timestamp"])
-    merged_data = consolidated_data.merge(existing_data, on=["SiteID", "Timestamp"], how="inner")
-    
-    if not merged_data.empty:
-        print(f"{len(merged_data)} registros duplicados encontrados en {table_name}. Serán ignorados.")
-        consolidated_data = consolidated_data[~consolidated_data.set_index(["SiteID", "Timestamp"]).index.isin(merged_data.set_index(["SiteID", "Timestamp"]).index)]
-    
-    if not consolidated_data.empty:
+        # La clave única resuelve los duplicados contra la historia con búsquedas en el índice;
+        # los archivos modificados reemplazan los valores que habían cargado antes
         print(f"Cargando datos en la tabla '{table_name}'...")
-        consolidated_data.to_sql(table_name, conn, if_exists="append", index=False)
-        print(f"{len(consolidated_data)} registros nuevos cargados en la base de datos.")
+        insertados = 0
+        duplicados = 0
+        with transaccion(conn):
+            for datos, actualizar in [(nuevos, False), (modificados, True)]:
+                if not datos:
+                    continue
+                datos = pd.concat(datos, ignore_index=True).drop_duplicates(subset=["SiteID", "Timestamp"], keep="last" if actualizar else "first")
+                escritos = _insertar_horario(conn, table_name, datos, actualizar)
+                insertados += escritos
+                duplicados += len(datos) - escritos
+            for archivo, filas in leidos:
+                registrar_ingesta(conn, archivo, filas)
+
+    if duplicados:
+        print(f"{duplicados} registros duplicados encontrados en {table_name}. Serán ignorados.")
+    if insertados:
+        print(f"{insertados} registros nuevos cargados en la base de datos.")
     else:
         print("No hay datos nuevos para cargar.")
     
@@ -150,23 +1094,7 @@ def process_files(conn, data_folder, file_type):
     if table_exists.empty:
         print(f"La tabla '{table_name}' no existe o está vacía.")
     else:
-        total_records = pd.read_sql_query(f"SELECT COUNT(*) AS total FROM {table_name}", conn)
-        site_count = pd.read_sql_query(f"SELECT COUNT(DISTINCT SiteID) AS site_count FROM {table_name}", conn)
-        date_range = pd.read_sql_query(f"""
-            SELECT MIN(Timestamp) AS start_date, 
-                   MAX(Timestamp) AS end_date 
-            FROM {table_name}
-        """, conn)
-        
-        print(f"Registros en la tabla '{table_name}': {total_records['total'][0]}")
-        print(f"Sitios únicos: {site_count['site_count'][0]}")
-        print(f"Información desde {date_range['start_date'][0]} hasta {date_range['end_date'][0]}")
-
-    os.makedirs(os.path.join(data_folder, "old"), exist_ok=True)
-    today = pd.Timestamp.today().strftime("%Y%m%d")
-    for file in files:
-        file_name = os.path.basename(file)
-        os.rename(file, os.path.join(data_folder, "old", file_name.replace(".xlsx", f"_procesado_{today}.xlsx")))
+        _resumen_tabla_horaria(conn, table_name)
 
 def consolidar_datos_sitios(conn, data_folder):
 
@@ -195,13 +1123,17 @@ def consolidar_datos_sitios(conn, data_folder):
         raise FileNotFoundError("No se encontraron todos los archivos requeridos en la carpeta.")
     
     def cargar_archivo(path, sheet_name=None, columns=None):
-        df = pd.read_excel(path, sheet_name=sheet_name) if sheet_name else pd.read_excel(path)
-        df.columns = df.columns.str.replace("\n", " ", regex=True)  # Reemplaza saltos de línea con espacio
-        df.columns = df.columns.str.strip().str.replace(r"\s+", " ", regex=True)  # Elimina espacios extra
-        df.columns = df.columns.str.replace(r"[^\w\s]", "", regex=True)  # Elimina caracteres especiales
-        df = df.reset_index()
+        def leer():
+            df = pd.read_excel(path, sheet_name=sheet_name) if sheet_name else pd.read_excel(path)
+            df.columns = df.columns.str.replace("\n", " ", regex=True)  # Reemplaza saltos de línea con espacio
+            df.columns = df.columns.str.strip().str.replace(r"\s+", " ", regex=True)  # Elimina espacios extra
+            df.columns = df.columns.str.replace(r"[^\w\s]", "", regex=True)  # Elimina caracteres especiales
+            df = df.reset_index()
 
-        return df.rename(columns=columns)[list(columns.values())].drop_duplicates(subset="SiteID", keep="last") if columns else df
+            return df.rename(columns=columns)[list(columns.values())].drop_duplicates(subset="SiteID", keep="last").reset_index(drop=True) if columns else df
+
+        # La caché guarda el resultado ya normalizado para esta hoja y columnas
+        return _leer_con_cache(path, leer, "sitios", sheet_name, columns)
     
     base_sitios = cargar_archivo(file_paths["base_sitios"], "Base de Sitios", {
         "Codigo Unico": "SiteID",
@@ -288,288 +1220,615 @@ def consolidar_datos_sitios(conn, data_folder):
     columnas_unidas = ", ".join(consolidated_data.columns)
     print(f"Columnas de la tabla de sitios: {columnas_unidas}")
 
-    consolidated_data.to_sql("SiteInfo", conn, if_exists="replace", index=False)
+    # Sitios nuevos, dados de baja o que cambiaron de cluster: se recalculan en el análisis de clusters;
+    # el cluster anterior también se recalcula porque perdió un sitio
+    if _existe_tabla(conn, "SiteInfo"):
+        clusters_anteriores = pd.read_sql_query("SELECT SiteID, Cluster FROM SiteInfo", conn)
+    else:
+        clusters_anteriores = pd.DataFrame(columns=["SiteID", "Cluster"])
+    cambios = consolidated_data[["SiteID", "Cluster"]].merge(clusters_anteriores, on="SiteID", how="outer", suffixes=("", "_anterior"))
+    cambios = cambios[cambios["Cluster"].astype(str) != cambios["Cluster_anterior"].astype(str)]
+    with transaccion(conn):
+        marcar_pendientes(conn, cambios["SiteID"], procesos=["cluster"])
+        conn.executemany("INSERT OR IGNORE INTO clusters_pendientes VALUES (?)", ((c,) for c in cambios["Cluster_anterior"].dropna().astype(str).unique()))
+
+    escribir_tabla(conn, consolidated_data, "SiteInfo")
     
     print(f"Tabla 'SiteInfo' creada exitosamente. Total registros: {len(consolidated_data)}")
     print(f"Sitios con FechaFinSwap no vacía: {consolidated_data['FechaFinSwap'].notna().sum()}")
 
+# Etapa base de cada sitio: desde el inicio de los datos hasta el día anterior al swap
+ETAPA_SIN_SWAP = "Sin Swap"
+
+# Calendario de etapas posteriores al swap, en orden: (Etapa, IngresoDesde, Inicio).
+# Un sitio entra a la última etapa cuyo IngresoDesde es <= su FechaFinSwap y la
+# empieza ese día; las siguientes empiezan en su Inicio. Cada etapa termina el
+# día anterior al Inicio de la siguiente; la última, con los datos de energía.
+# Un hito nuevo es una fila más en la tabla calendario_etapas.
+CALENDARIO_ETAPAS = [
+    ("Swap 0 Features", None, None),
+    ("Swap 3 Legacy", "2024-11-08", "2024-11-20"),
+    ("Swap 3 Legacy + PrSc", "2025-01-28", "2025-01-28"),
+]
+
+def asegurar_calendario_etapas(conn):
+    """
+    Crea calendario_etapas (sembrada con CALENDARIO_ETAPAS si está vacía) y
+    la devuelve ordenada por IngresoDesde, con las fechas como datetime.
+    """
+    with transaccion(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS calendario_etapas (
+                Etapa TEXT PRIMARY KEY,
+                IngresoDesde DATE,
+                Inicio DATE
+            )
+        """)
+        if conn.execute("SELECT COUNT(*) FROM calendario_etapas").fetchone()[0] == 0:
+            conn.executemany("INSERT INTO calendario_etapas VALUES (?, ?, ?)", CALENDARIO_ETAPAS)
+    calendario = pd.read_sql_query("SELECT Etapa, IngresoDesde, Inicio FROM calendario_etapas ORDER BY IngresoDesde", conn)
+    calendario["IngresoDesde"] = pd.to_datetime(calendario["IngresoDesde"])
+    calendario["Inicio"] = pd.to_datetime(calendario["Inicio"])
+    return calendario
+
+def generar_etapas(sitios, calendario):
+    """
+    Intervalos de etapa de todos los sitios a la vez. `sitios` trae SiteID,
+    FechaFinSwap, FechaInicioEnergia y FechaMaxEnergia; `calendario` es el de
+    asegurar_calendario_etapas.
+    - "Sin Swap": desde el inicio de los datos hasta el día anterior al swap
+      (o hasta el fin de los datos si no hay swap).
+    - Con swap: etapas del calendario desde la de ingreso, cada una acotada
+      al fin de los datos.
+    Solo se generan las etapas con FechaFin >= FechaInicio.
+    """
+    dia = np.timedelta64(1, "D")
+    sitios = sitios.dropna(subset=["FechaInicioEnergia", "FechaMaxEnergia"])
+    site_id = sitios["SiteID"].to_numpy()
+    swap = sitios["FechaFinSwap"].to_numpy(dtype="datetime64[D]")
+    inicio_datos = sitios["FechaInicioEnergia"].to_numpy(dtype="datetime64[D]")
+    fin_datos = sitios["FechaMaxEnergia"].to_numpy(dtype="datetime64[D]")
+    con_swap = ~np.isnat(swap)
+
+    # Sin Swap
+    fin = np.where(con_swap, np.minimum(swap - dia, fin_datos), fin_datos)
+    partes = [(site_id, np.full(len(site_id), ETAPA_SIN_SWAP, dtype=object), inicio_datos, fin)]
+
+    # Etapas del calendario: cruce sitio con swap x etapa
+    etapas = calendario["Etapa"].to_numpy(dtype=object)
+    if len(etapas) and con_swap.any():
+        ingreso = calendario["IngresoDesde"].to_numpy(dtype="datetime64[D]")
+        inicio_hito = calendario["Inicio"].to_numpy(dtype="datetime64[D]")
+        # Fin nominal: día anterior al Inicio de la siguiente etapa (la última no tiene)
+        fin_hito = np.r_[inicio_hito[1:] - dia, np.datetime64("NaT", "D")]
+
+        swap, fin_datos, site_id = swap[con_swap], fin_datos[con_swap], site_id[con_swap]
+        ingreso_ordenable = np.where(np.isnat(ingreso), np.datetime64("0001-01-01", "D"), ingreso)
+        entrada = np.maximum(np.searchsorted(ingreso_ordenable, swap, side="right") - 1, 0)
+
+        n, k = len(swap), len(etapas)
+        etapa = np.tile(np.arange(k), n)
+        sitio = np.repeat(np.arange(n), k)
+        seguir = etapa >= entrada[sitio]
+        etapa, sitio = etapa[seguir], sitio[seguir]
+
+        inicio = np.where(etapa == entrada[sitio], swap[sitio], inicio_hito[etapa])
+        fin = np.where(np.isnat(fin_hito[etapa]), fin_datos[sitio], np.minimum(fin_hito[etapa], fin_datos[sitio]))
+        partes.append((site_id[sitio], etapas[etapa], inicio, fin))
+
+    etapas_df = pd.DataFrame({
+        "SiteID": np.concatenate([p[0] for p in partes]),
+        "Etapa": np.concatenate([p[1] for p in partes]),
+        "FechaInicio": np.concatenate([p[2] for p in partes]),
+        "FechaFin": np.concatenate([p[3] for p in partes])
+    })
+    etapas_df = etapas_df[etapas_df["FechaFin"] >= etapas_df["FechaInicio"]]
+    etapas_df = etapas_df.sort_values(by=["SiteID", "FechaInicio"], kind="stable").reset_index(drop=True)
+    etapas_df["FechaInicio"] = etapas_df["FechaInicio"].dt.date
+    etapas_df["FechaFin"] = etapas_df["FechaFin"].dt.date
+    return etapas_df
+
 def calcular_etapas_sitios(conn, data_folder):
+    """
+    Etapas de cada sitio (SiteStages) según su fecha de swap, sus datos de
+    energía y el calendario de hitos (calendario_etapas).
+    """
     excel_path = os.path.join(data_folder, "SITE_ETAPAS.xlsx")
     
     # 1. Leer la información consolidada de la base de datos
     query_sitios = "SELECT SiteID, FechaFinSwap FROM SiteInfo"
     sitios_data = pd.read_sql_query(query_sitios, conn)
     
-    query_energia = """
-        SELECT SiteID, 
-               MIN(`Timestamp`) AS FechaInicioEnergia, 
-               MAX(`Timestamp`) AS FechaMaxEnergia 
-        FROM EnergyConsumption 
-        GROUP BY SiteID
-    """
+    if es_esquema_compacto(conn, "EnergyConsumption"):
+        # Agregado directo sobre la clave entera, sin pasar por la vista
+        query_energia = """
+            SELECT s.SiteID, 
+                   datetime(e.HoraMin * 3600, 'unixepoch') AS FechaInicioEnergia, 
+                   datetime(e.HoraMax * 3600, 'unixepoch') AS FechaMaxEnergia 
+            FROM (SELECT SiteKey, MIN(Hora) AS HoraMin, MAX(Hora) AS HoraMax 
+                  FROM EnergyConsumption_compacta GROUP BY SiteKey) AS e
+            JOIN Sitios AS s ON s.SiteKey = e.SiteKey
+        """
+    else:
+        query_energia = """
+            SELECT SiteID, 
+                   MIN(`Timestamp`) AS FechaInicioEnergia, 
+                   MAX(`Timestamp`) AS FechaMaxEnergia 
+            FROM EnergyConsumption 
+            GROUP BY SiteID
+        """
     energia_data = pd.read_sql_query(query_energia, conn)
     
     # 2. Fusionar información
     sitios_data = sitios_data.merge(energia_data, on="SiteID", how="left")
-    sitios_data["FechaFinSwap"]       = pd.to_datetime(sitios_data["FechaFinSwap"]).dt.date
-    sitios_data["FechaInicioEnergia"] = pd.to_datetime(sitios_data["FechaInicioEnergia"]).dt.date
-    sitios_data["FechaMaxEnergia"]    = pd.to_datetime(sitios_data["FechaMaxEnergia"]).dt.date
-    
-    # 3. Fechas de referencia (según tu tabla “corregida”)
-    fecha_corte_1 = date(2024, 11, 8)   #  8-Nov-24
-    fecha_swap_end= date(2024, 11, 19)  # 19-Nov-24
-    fecha_legacy_start = date(2024, 11, 20)  # 20-Nov-24
-    fecha_legacy_end   = date(2025, 1, 27)   # 27-Ene-25
-    fecha_legacy_ps    = date(2025, 1, 28)   # 28-Ene-25
-    
-    etapas = []
-
-    for _, row in sitios_data.iterrows():
-        site_id             = row["SiteID"]
-        fecha_inicio_energia= row["FechaInicioEnergia"]
-        fecha_fin_swap      = row["FechaFinSwap"]
-        fecha_max_energia   = row["FechaMaxEnergia"]
-        
-        # Validaciones básicas
-        if pd.isna(fecha_inicio_energia) or pd.isna(fecha_max_energia):
-            # Si no tenemos fechas de energía, no generamos etapas
-            continue
-        
-        # -----------------------------------------------------------
-        # ETAPA: SIN SWAP (si existe fecha_fin_swap, va hasta el día anterior)
-        # -----------------------------------------------------------
-        if not pd.isna(fecha_fin_swap):
-            fin_sin_swap = min(fecha_fin_swap - pd.Timedelta(days=1), fecha_max_energia)
-        else:
-            # Si no hay fecha_fin_swap, va hasta el fin de los datos
-            fin_sin_swap = fecha_max_energia
-        
-        if fin_sin_swap >= fecha_inicio_energia:
-            etapas.append({
-                "SiteID"      : site_id,
-                "Etapa"       : "Sin Swap",
-                "FechaInicio" : fecha_inicio_energia,
-                "FechaFin"    : fin_sin_swap
-            })
-        
-        # Si no existe fecha_fin_swap, no hay más etapas que agregar
-        if pd.isna(fecha_fin_swap):
-            continue
-        
-        # -----------------------------------------------------------
-        # CLASIFICACIÓN EN 3 CASOS
-        # -----------------------------------------------------------
-        
-        # CASO 1: fecha_fin_swap < 8‑Nov‑24
-        if fecha_fin_swap < fecha_corte_1:
-            # Swap: fecha_fin_swap → 19‑Nov‑24
-            inicio_swap = fecha_fin_swap
-            fin_swap    = min(fecha_swap_end, fecha_max_energia)  # 19-Nov-24
-            if fin_swap >= inicio_swap:
-                etapas.append({
-                    "SiteID"      : site_id,
-                    "Etapa"       : "Swap 0 Features",
-                    "FechaInicio" : inicio_swap,
-                    "FechaFin"    : fin_swap
-                })
-            
-            # Swap_Legacy: 20‑Nov‑24 → 27‑Ene‑25
-            inicio_legacy = fecha_legacy_start  # 20-Nov-24
-            fin_legacy    = min(fecha_legacy_end, fecha_max_energia)  # 27-Ene-25
-            if fin_legacy >= inicio_legacy:
-                etapas.append({
-                    "SiteID"      : site_id,
-                    "Etapa"       : "Swap 3 Legacy",
-                    "FechaInicio" : inicio_legacy,
-                    "FechaFin"    : fin_legacy
-                })
-            
-            # Swap_Legacy_PS: 28‑Ene‑25 → fecha_max_energia
-            if fecha_max_energia >= fecha_legacy_ps:
-                etapas.append({
-                    "SiteID"      : site_id,
-                    "Etapa"       : "Swap 3 Legacy + PrSc",
-                    "FechaInicio" : fecha_legacy_ps,
-                    "FechaFin"    : fecha_max_energia
-                })
-        
-        # CASO 2: 8‑Nov‑24 <= fecha_fin_swap < 28‑Ene‑25
-        elif fecha_fin_swap < fecha_legacy_ps:
-            # Swap_Legacy: fecha_fin_swap → 27‑Ene‑25
-            inicio_legacy = fecha_fin_swap
-            fin_legacy    = min(fecha_legacy_end, fecha_max_energia)
-            if fin_legacy >= inicio_legacy:
-                etapas.append({
-                    "SiteID"      : site_id,
-                    "Etapa"       : "Swap 3 Legacy",
-                    "FechaInicio" : inicio_legacy,
-                    "FechaFin"    : fin_legacy
-                })
-            
-            # Swap_Legacy_PS: 28‑Ene‑25 → fecha_max_energia
-            if fecha_max_energia >= fecha_legacy_ps:
-                etapas.append({
-                    "SiteID"      : site_id,
-                    "Etapa"       : "Swap 3 Legacy + PrSc",
-                    "FechaInicio" : fecha_legacy_ps,
-                    "FechaFin"    : fecha_max_energia
-                })
-        
-        # CASO 3: fecha_fin_swap >= 28‑Ene‑25
-        else:
-            # Aquí ya NO hay "Swap" ni "Swap_Legacy".
-            # Solo “Swap_Legacy_PS” a partir de 28-Ene-25
-            if fecha_max_energia >= fecha_legacy_ps:
-                etapas.append({
-                    "SiteID"      : site_id,
-                    "Etapa"       : "Swap 3 Legacy + PrSc",
-                    "FechaInicio" : fecha_fin_swap,
-                    "FechaFin"    : fecha_max_energia
-                })
-
-    # 4. Convertir a DataFrame, ordenar y guardar
-    etapas_df = pd.DataFrame(etapas)
-    etapas_df = etapas_df.sort_values(by=["SiteID", "FechaInicio"]).reset_index(drop=True)
+    sitios_data["FechaFinSwap"]       = pd.to_datetime(sitios_data["FechaFinSwap"]).dt.normalize()
+    sitios_data["FechaInicioEnergia"] = pd.to_datetime(sitios_data["FechaInicioEnergia"]).dt.normalize()
+    sitios_data["FechaMaxEnergia"]    = pd.to_datetime(sitios_data["FechaMaxEnergia"]).dt.normalize()
+
+    # 3. Etapas de todos los sitios según el calendario de hitos
+    etapas_df = generar_etapas(sitios_data, asegurar_calendario_etapas(conn))
+
+    # Sitios cuyas etapas cambiaron: se recalculan en el análisis de consumo y de clusters
+    columnas_etapa = ["SiteID", "Etapa", "FechaInicio", "FechaFin"]
+    nuevas = etapas_df[columnas_etapa].astype(str)
+    if _existe_tabla(conn, "SiteStages"):
+        anteriores = pd.read_sql_query("SELECT SiteID, Etapa, FechaInicio, FechaFin FROM SiteStages", conn).astype(str)
+    else:
+        anteriores = pd.DataFrame(columns=columnas_etapa)
+    diferencias = nuevas.merge(anteriores, on=columnas_etapa, how="outer", indicator=True)
+    sitios_cambiados = diferencias.loc[diferencias["_merge"] != "both", "SiteID"].unique()
+    with transaccion(conn):
+        marcar_pendientes(conn, sitios_cambiados)
+    print(f"Sitios con etapas nuevas o modificadas: {len(sitios_cambiados)}")
     
     # Guardar en la base de datos
-    etapas_df.to_sql("SiteStages", conn, if_exists="replace", index=False)
+    escribir_tabla(conn, etapas_df, "SiteStages")
     
     # Guardar en Excel
     etapas_df.to_excel(excel_path, index=False)
     
     print(f"Tabla 'SiteStages' recalculada y guardada. Total registros: {len(etapas_df)}")
 
-def calcular_consumo(conn):
-    # Leer datos una sola vez
-    print("Leyendo datos desde la base de datos...")
-    energy_data = pd.read_sql_query("SELECT * FROM EnergyConsumption", conn)
-    site_info = pd.read_sql_query("SELECT * FROM SiteInfo", conn)
-    traffic_info = pd.read_sql_query("SELECT * FROM TrafficData", conn)
-    site_stages = pd.read_sql_query("SELECT * FROM SiteStages", conn)
-
-    # Convertir fechas a datetime una sola vez
-    energy_data["Timestamp"] = pd.to_datetime(energy_data["Timestamp"])
-    site_info["FechaFinSwap"] = pd.to_datetime(site_info["FechaFinSwap"])
-    traffic_info["Timestamp"] = pd.to_datetime(traffic_info["Timestamp"])
-    site_stages["FechaInicio"] = pd.to_datetime(site_stages["FechaInicio"])
-    site_stages["FechaFin"] = pd.to_datetime(site_stages["FechaFin"])
-
-    results = []
-    weeks = []
-
-    for tipo_de_analisis, horas in [("24h", (0, 23)), ("Nocturno", (0, 6))]:
-        print(f"Procesando datos para análisis: {tipo_de_analisis}...")
-
-        # Filtrar datos según el tipo de análisis
-        energy_filtered = energy_data[energy_data["Timestamp"].dt.hour.between(*horas)]
-        traffic_filtered = traffic_info[traffic_info["Timestamp"].dt.hour.between(*horas)]
-        multiplier = 24 if tipo_de_analisis == "24h" else 6
-
-        # Agregar columna de fecha
-        energy_filtered = energy_filtered.copy()
-        energy_filtered["Date"] = energy_filtered["Timestamp"].dt.date
+def asignar_etapas(diario, site_stages, columna_fecha="FinalDate"):
+    """
+    Etiqueta cada fila diaria con la etapa de su sitio cuyo intervalo
+    [FechaInicio, FechaFin] contiene la fecha, con una búsqueda ordenada sobre
+    los inicios de etapa (merge_asof por sitio) en lugar de cruzar cada día
+    con todas las etapas. Las filas fuera de toda etapa se descartan; las
+    etapas de un sitio no se solapan.
+    El índice del resultado es la posición que la fila tenía en el cruce
+    día x etapa (la interpolación Akima lo usa como abscisa).
+    """
+    etapas = site_stages.copy()
+    etapas["_orden_etapa"] = etapas.groupby("SiteID", observed=True).cumcount()
+    etapas_por_sitio = etapas.groupby("SiteID", observed=True).size()
 
-        traffic_filtered = traffic_filtered.copy()
-        traffic_filtered["Date"] = traffic_filtered["Timestamp"].dt.date
+    # Posición en el cruce: cada día ocupa tantas filas como etapas tiene su sitio (mínimo una)
+    filas_cruce = diario["SiteID"].map(etapas_por_sitio).fillna(1).astype("int64")
+    inicio_cruce = filas_cruce.cumsum() - filas_cruce
 
-        # Agrupar por día y sitio, escalando valores según tipo de análisis
-        daily_energy = energy_filtered.groupby(["SiteID", "Date"])["Consumption"].mean().reset_index()
-        daily_energy["Consumption"] *= multiplier
+    izquierda = diario.assign(_inicio_cruce=inicio_cruce.to_numpy()).dropna(subset=[columna_fecha])
+    izquierda = izquierda.sort_values(columna_fecha, kind="stable")
+    derecha = etapas.dropna(subset=["FechaInicio"]).sort_values("FechaInicio", kind="stable")
 
-        daily_traffic = traffic_filtered.groupby(["SiteID", "Date"])["TrafficData"].mean().reset_index()
-        daily_traffic["TrafficData"] *= multiplier
+    asignado = pd.merge_asof(
+        izquierda.reset_index(names="_fila"), derecha,
+        left_on=columna_fecha, right_on="FechaInicio", by="SiteID", direction="backward"
+    ).set_index("_fila").sort_index()
+    asignado = asignado[asignado[columna_fecha] <= asignado["FechaFin"]]
 
-        # Unir consumo de energía con tráfico de datos
-        daily_consumption = pd.merge(daily_energy, daily_traffic, on=["SiteID", "Date"], how="outer")
-        daily_consumption["FinalDate"] = pd.to_datetime(daily_consumption["Date"])
+    asignado.index = (asignado["_inicio_cruce"] + asignado["_orden_etapa"]).astype("int64").rename(None)
+    return asignado.drop(columns=["_inicio_cruce", "_orden_etapa"])
 
-        # Unir con información de etapas de cada sitio
-        daily_consumption = daily_consumption.merge(site_stages, on="SiteID", how="left")
-        daily_consumption = daily_consumption[
-            (daily_consumption["FinalDate"] >= daily_consumption["FechaInicio"]) & 
-            (daily_consumption["FinalDate"] <= daily_consumption["FechaFin"])
-        ]
+def _pendientes_akima(xs, ys, inicio, puntos):
+    """
+    Pendientes en los nodos de cada grupo con la fórmula de
+    scipy.interpolate.Akima1DInterpolator (method="akima"). Los nodos de cada
+    grupo son contiguos en xs/ys y empiezan en `inicio`; cada grupo tiene al
+    menos 3 puntos.
+    """
+    grupos = len(inicio)
+    grupo = np.repeat(np.arange(grupos), puntos)
+    q = np.arange(len(xs)) - inicio[grupo]
+
+    # Pendientes de los tramos con dos extra a cada lado: grupos de puntos + 3 valores
+    base = inicio + 3 * np.arange(grupos)
+    m = np.empty(len(xs) + 3 * grupos)
+    tramo = np.flatnonzero(q < puntos[grupo] - 1)
+    m[base[grupo[tramo]] + 2 + q[tramo]] = np.diff(ys)[tramo] / np.diff(xs)[tramo]
+    m[base + 1] = 2. * m[base + 2] - m[base + 3]
+    m[base] = 2. * m[base + 1] - m[base + 2]
+    fin = base + puntos
+    m[fin + 1] = 2. * m[fin] - m[fin - 1]
+    m[fin + 2] = 2. * m[fin + 1] - m[fin]
+
+    b = base[grupo] + q
+    m0, m1, m2, m3 = m[b], m[b + 1], m[b + 2], m[b + 3]
+    t = .5 * (m3 + m0)
+    f1 = np.abs(m3 - m2)
+    f2 = np.abs(m1 - m0)
+    f12 = f1 + f2
+    definida = f12 > 1.e-9 * np.maximum.reduceat(f12, inicio)[grupo]
+    t[definida] = m1[definida] + (f2[definida] / f12[definida]) * (m2[definida] - m1[definida])
+    return t
+
+def _interpolar_plano(x, y, k, minimo_akima):
+    """
+    Interpola `y` dentro de cada grupo `k` (códigos 0..G-1 contiguos y
+    ordenados). Devuelve una copia con los vacíos rellenos.
+    """
+    n = len(y)
+    fila = np.arange(n)
+    inicio = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+    fin = np.r_[inicio[1:], n]
+
+    valido = ~np.isnan(y)
+    datos = np.bincount(k, weights=valido)
+    anterior = np.maximum.accumulate(np.where(valido, fila, -1))
+    siguiente = np.minimum.accumulate(np.where(valido, fila, n)[::-1])[::-1]
+    hueco = ~valido & (anterior >= inicio[k])  # los vacíos iniciales se conservan
+    interior = siguiente < fin[k]
+    akima = datos[k] >= minimo_akima
+    resultado = y.copy()
+
+    # Lineal por posición (como np.interp): los vacíos finales toman el último dato
+    filas = np.flatnonzero(hueco & ~akima)
+    a, b = anterior[filas], siguiente[filas]
+    resultado[filas] = y[a]
+    filas, a, b = filas[interior[filas]], a[interior[filas]], b[interior[filas]]
+    pendiente = (y[b] - y[a]) / (b - a).astype("float64")
+    resultado[filas] = pendiente * (filas - a) + y[a]
+
+    # Akima sobre la abscisa x (como Akima1DInterpolator sin extrapolar): los vacíos finales quedan NaN
+    nodos = np.flatnonzero(valido & akima)
+    filas = np.flatnonzero(hueco & akima)
+    resultado[filas[~interior[filas]]] = np.nan
+    filas = filas[interior[filas]]
+    if len(filas):
+        xs, ys = x[nodos], y[nodos]
+        inicio_nodos = np.flatnonzero(np.r_[True, k[nodos][1:] != k[nodos][:-1]])
+        t = _pendientes_akima(xs, ys, inicio_nodos, np.diff(np.r_[inicio_nodos, len(nodos)]))
+
+        a = np.searchsorted(nodos, anterior[filas])
+        dx = xs[a + 1] - xs[a]
+        pendiente = (ys[a + 1] - ys[a]) / dx
+        tt = (t[a] + t[a + 1] - 2 * pendiente) / dx
+        c0, c1, c2, c3 = tt / dx, (pendiente - t[a]) / dx - tt, t[a], ys[a]
+        s = x[filas] - xs[a]
+        z = s * s
+        resultado[filas] = c3 + c2 * s + c1 * z + c0 * (z * s)
+    return resultado
+
+def interpolar_por_grupo(df, columnas, claves, minimo_akima=4):
+    """
+    Rellena los vacíos de `columnas` dentro de cada grupo `claves` con la regla
+    de Series.interpolate por grupo: Akima (abscisa = índice) si el grupo tiene
+    al menos `minimo_akima` datos, si no lineal por posición. Los NaN iniciales
+    se conservan; los finales quedan NaN en Akima y toman el último dato en
+    lineal. Se calcula para todos los grupos a la vez sobre arreglos planos,
+    sin un llamado a SciPy por grupo.
+    """
+    codigos = df.groupby(claves, sort=False, observed=True).ngroup().to_numpy()
+    orden = np.argsort(codigos, kind="stable")
+    k = np.unique(codigos[orden], return_inverse=True)[1]
+    x = df.index.to_numpy(dtype="float64")[orden]
+
+    df = df.copy()
+    for col in columnas:
+        y = df[col].to_numpy(dtype="float64")[orden]
+        valores = np.empty(len(y))
+        valores[orden] = _interpolar_plano(x, y, k, minimo_akima)
+        df[col] = valores.astype(df[col].dtype, copy=False)
+    return df
+
+# Columnas de etiqueta que el modo ligero guarda como category
+COLUMNAS_ETIQUETA = ["SiteID", "Etapa", "Analisis", "Grafico", "Cluster"]
+
+def aligerar(df, metricas=()):
+    """
+    Modo ligero: columnas de etiqueta como category y `metricas` en float32
+    (precisión suficiente para promedios de kWh y GB). Modifica `df`.
+    """
+    for columna in COLUMNAS_ETIQUETA:
+        if columna in df.columns and not isinstance(df[columna].dtype, pd.CategoricalDtype):
+            df[columna] = df[columna].astype("category")
+    for columna in metricas:
+        if columna in df.columns:
+            df[columna] = df[columna].astype("float32")
+    return df
+
+@contextmanager
+def medir_memoria(etapa, activo=True):
+    """Informa el pico de memoria asignada (tracemalloc) durante el bloque."""
+    if not activo:
+        yield
+        return
+    iniciado = not tracemalloc.is_tracing()
+    if iniciado:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        pico = tracemalloc.get_traced_memory()[1]
+        if iniciado:
+            tracemalloc.stop()
+        print(f"🧠 {etapa}: pico de memoria {pico / 1024**2:,.1f} MiB")
+
+def particionar_sitios(sitios, particiones):
+    """
+    Reparte `sitios` en `particiones` grupos según un hash estable del SiteID
+    (el mismo sitio cae siempre en la misma partición). Omite las vacías.
+    """
+    grupos = [[] for _ in range(particiones)]
+    for sitio in sitios:
+        grupos[zlib.crc32(str(sitio).encode("utf-8")) % particiones].append(sitio)
+    return [grupo for grupo in grupos if grupo]
 
-        # Calcular límites superior e inferior de consumo y tráfico
-        for col in ["Consumption", "TrafficData"]:
-            daily_consumption[f"Mean{col}"] = daily_consumption.groupby(["SiteID", "Etapa"])[col].transform("mean")
-            daily_consumption[f"UpperLimit{col}"] = daily_consumption[f"Mean{col}"] * 1.2
-            daily_consumption[f"LowerLimit{col}"] = daily_consumption[f"Mean{col}"] * 0.8
-            daily_consumption[f"Original{col}"] = daily_consumption[col]
-
-        # Ajustar valores fuera de los límites usando `clip`
-        daily_consumption["Consumption"] = daily_consumption["Consumption"].clip(
-            lower=daily_consumption["LowerLimitConsumption"],
-            upper=daily_consumption["UpperLimitConsumption"]
-        )
-        daily_consumption["TrafficData"] = daily_consumption["TrafficData"].clip(
-            lower=daily_consumption["LowerLimitTrafficData"],
-            upper=daily_consumption["UpperLimitTrafficData"]
-        )
+def _ruta_base(conn):
+    """Archivo de la base principal de `conn` ("" si está en memoria)."""
+    return conn.execute("PRAGMA database_list").fetchone()[2]
 
-        # Interpolación de datos
-        def interpolate_site(group):
-            for col in ["Consumption", "TrafficData"]:
-                method = "akima" if group[col].notna().sum() >= 4 else "linear"
-                group[col] = group[col].interpolate(method=method)
-            return group
+def _leer_consumo(conn, filtrar=False, ligero=False):
+    """
+    Resumen diario por ventana y etapas de los sitios; con filtrar=True solo
+    los de la tabla temporal _sitios_calculo. ligero=True: etiquetas como
+    category (SiteID con las mismas categorías en ambas tablas) y valores en float32.
+    """
+    filtro_sitios = "WHERE SiteID IN (SELECT SiteID FROM _sitios_calculo)" if filtrar else ""
+    consulta = f"""
+        SELECT r.SiteID, r.Fecha AS Date, r.Analisis, r.Consumption, r.TrafficData, v.Multiplicador
+        FROM resumen_diario AS r
+        JOIN ventanas_analisis AS v ON v.Analisis = r.Analisis
+        {filtro_sitios.replace("WHERE SiteID", "WHERE r.SiteID")}
+        ORDER BY v.rowid, r.SiteID, r.Fecha
+    """
+    site_stages = pd.read_sql_query(f"SELECT * FROM SiteStages {filtro_sitios}", conn)
+    site_stages["FechaInicio"] = pd.to_datetime(site_stages["FechaInicio"])
+    site_stages["FechaFin"] = pd.to_datetime(site_stages["FechaFin"])
 
-        daily_consumption = daily_consumption.groupby("SiteID").apply(interpolate_site)
+    if not ligero:
+        daily_consumption = pd.read_sql_query(consulta, conn)
+        # Convertir fechas a datetime una sola vez
+        daily_consumption["Date"] = pd.to_datetime(daily_consumption["Date"]).dt.date
+        return daily_consumption, site_stages
+
+    # Lectura por bloques, cada uno ya con sus tipos ligeros: el resumen
+    # completo nunca está en memoria como objetos Python
+    sitios = {row[0] for row in conn.execute(f"SELECT DISTINCT SiteID FROM resumen_diario {filtro_sitios}")}
+    ventanas = [row[0] for row in conn.execute("SELECT Analisis FROM ventanas_analisis")]
+    tipos = {
+        "SiteID": pd.CategoricalDtype(sorted(sitios | set(site_stages["SiteID"]))),
+        "Analisis": pd.CategoricalDtype(sorted(ventanas)),
+        "Consumption": "float32", "TrafficData": "float32", "Multiplicador": "float32"
+    }
+    bloques = []
+    for bloque in pd.read_sql_query(consulta, conn, chunksize=FILAS_BLOQUE):
+        bloque = bloque.astype(tipos)
+        bloque["Date"] = pd.to_datetime(bloque["Date"]).dt.date
+        bloques.append(bloque)
+    daily_consumption = pd.concat(bloques, ignore_index=True)
+    site_stages["SiteID"] = site_stages["SiteID"].astype(tipos["SiteID"])
+    aligerar(site_stages)
+    return daily_consumption, site_stages
+
+def _procesar_consumo(daily_consumption, site_stages, ligero=False):
+    """
+    Cálculo por sitio de calcular_consumo: etapas, límites, interpolación,
+    kWh/GB y semana ideal. Cada sitio es independiente de los demás.
+    Devuelve (datos diarios, semana ideal). ligero=True: los límites
+    superior e inferior no se guardan en el DataFrame durante el cálculo,
+    solo se agregan al resultado.
+    """
+    # Escalar valores según tipo de análisis
+    daily_consumption["Consumption"] *= daily_consumption["Multiplicador"]
+    daily_consumption["TrafficData"] *= daily_consumption["Multiplicador"]
+    daily_consumption = daily_consumption.drop(columns="Multiplicador")
+    daily_consumption["FinalDate"] = pd.to_datetime(daily_consumption["Date"])
+
+    # Unir con información de etapas de cada sitio
+    daily_consumption = asignar_etapas(daily_consumption, site_stages)
+
+    # Calcular límites superior e inferior de consumo y tráfico
+    # y ajustar los valores fuera de los límites usando `clip`
+    for col in ["Consumption", "TrafficData"]:
+        media, inferior, superior = est.limites_media(daily_consumption, ["Analisis", "SiteID", "Etapa"], col, 0.2)
+        daily_consumption[f"Mean{col}"] = media
+        if not ligero:
+            daily_consumption[f"UpperLimit{col}"] = superior
+            daily_consumption[f"LowerLimit{col}"] = inferior
+        daily_consumption[f"Original{col}"] = daily_consumption[col]
+        daily_consumption[col] = daily_consumption[col].clip(lower=inferior, upper=superior)
+
+    # Interpolación de datos: Akima si el sitio tiene al menos 4 datos, si no lineal
+    daily_consumption = interpolar_por_grupo(daily_consumption, ["Consumption", "TrafficData"], ["Analisis", "SiteID"])
+
+    # Calcular eficiencia energética kW por GB
+    daily_consumption["kWperGB_Original"] = np.where(
+        (daily_consumption["OriginalConsumption"].notna()) & (daily_consumption["OriginalTrafficData"].notna()) & (daily_consumption["OriginalTrafficData"] != 0),
+        daily_consumption["OriginalConsumption"] / daily_consumption["OriginalTrafficData"], np.nan
+    )
 
-        # Calcular eficiencia energética kW por GB
-        daily_consumption["kWperGB_Original"] = np.where(
-            (daily_consumption["OriginalConsumption"].notna()) & (daily_consumption["OriginalTrafficData"].notna()) & (daily_consumption["OriginalTrafficData"] != 0),
-            daily_consumption["OriginalConsumption"] / daily_consumption["OriginalTrafficData"], np.nan
-        )
+    daily_consumption["kWperGB"] = np.where(
+        (daily_consumption["Consumption"].notna()) & (daily_consumption["TrafficData"].notna()) & (daily_consumption["TrafficData"] != 0),
+        daily_consumption["Consumption"] / daily_consumption["TrafficData"], np.nan
+    )
 
-        daily_consumption["kWperGB"] = np.where(
-            (daily_consumption["Consumption"].notna()) & (daily_consumption["TrafficData"].notna()) & (daily_consumption["TrafficData"] != 0),
-            daily_consumption["Consumption"] / daily_consumption["TrafficData"], np.nan
-        )
+    # Identificar la mejor semana solo si hay datos en todos los días de la semana
+    daily_consumption["DayOfWeek"] = daily_consumption["FinalDate"].dt.weekday + 1  # Lunes=1, Domingo=7
+    daily_consumption["WeekNumber"] = daily_consumption["FinalDate"].dt.isocalendar().week
 
-        # Identificar la mejor semana solo si hay datos en todos los días de la semana
-        daily_consumption["DayOfWeek"] = daily_consumption["FinalDate"].dt.weekday + 1  # Lunes=1, Domingo=7
-        daily_consumption["WeekNumber"] = daily_consumption["FinalDate"].dt.isocalendar().week
+    # Asegurar que 'SiteID' sea solo una columna, no índice
+    daily_consumption = daily_consumption.reset_index(drop=True)
 
-        # Asegurar que 'SiteID' sea solo una columna, no índice
-        daily_consumption = daily_consumption.reset_index(drop=True)
+    # Semana ideal: solo etapas con los 7 días de la semana; por día se quitan
+    # las 2 primeras y 2 últimas fechas (1 y 1 si hay de 3 a 5) antes de promediar
+    claves_etapa = ["Analisis", "SiteID", "Etapa"]
+    semana_completa = daily_consumption.groupby(claves_etapa, observed=True)["DayOfWeek"].transform("nunique") == 7
+    semana_ideal = est.recortar_por_posicion(daily_consumption[semana_completa], claves_etapa + ["DayOfWeek"], est.NIVELES_SEMANA)
+    semana_ideal = semana_ideal.groupby(claves_etapa + ["DayOfWeek"], observed=True).agg({
+        "Consumption": "mean",
+        "TrafficData": "mean",
+        "kWperGB": "mean"
+    }).reset_index()
 
-        # Aplicar el agrupamiento correctamente
-        semana_ideal = daily_consumption.groupby(["SiteID", "Etapa"]).filter(lambda x: x["DayOfWeek"].nunique() == 7)
-        semana_ideal = semana_ideal.groupby(["SiteID", "Etapa", "DayOfWeek"]).apply(
-            lambda x: x.iloc[2:-2] if len(x) >= 6 else x.iloc[1:-1] if len(x) >= 3 else x
-        ).groupby(level=["SiteID", "Etapa", "DayOfWeek"]).agg({  # Modificación aquí: usar level en groupby
-            "Consumption": "mean",
-            "TrafficData": "mean",
-            "kWperGB": "mean"
-        }).reset_index()
+    # Mismo orden de columnas que el cálculo por ventana: Analisis al final
+    final_data = daily_consumption[[c for c in daily_consumption.columns if c != "Analisis"] + ["Analisis"]]
+    final_data = final_data.assign(Grafico="Data")
+    final_weeks = semana_ideal[[c for c in semana_ideal.columns if c != "Analisis"] + ["Analisis"]]
+    final_weeks = final_weeks.assign(WeekNumber="Prom", Grafico="Promedios")
 
-        daily_consumption["Analisis"] = tipo_de_analisis
-        semana_ideal["Analisis"] = tipo_de_analisis
-        semana_ideal["WeekNumber"] = "Prom"
+    if ligero:
+        for col in ["Consumption", "TrafficData"]:
+            _, inferior, superior = est.limites_media(final_data, None, col, 0.2, media=final_data[f"Mean{col}"])
+            posicion = final_data.columns.get_loc(f"Mean{col}") + 1
+            final_data.insert(posicion, f"UpperLimit{col}", superior)
+            final_data.insert(posicion + 1, f"LowerLimit{col}", inferior)
+    return final_data, final_weeks
+
+def _consumo_particion(base_route, sitios, ligero=False):
+    """Trabajo de un proceso: lee de la base solo `sitios` y calcula su consumo."""
+    conn = sqlite3.connect(base_route)
+    try:
+        _sitios_calculo(conn, sitios)
+        return _procesar_consumo(*_leer_consumo(conn, filtrar=True, ligero=ligero), ligero=ligero)
+    finally:
+        conn.close()
 
-        results.append(daily_consumption)
-        weeks.append(semana_ideal)
+def _unir_particiones(resultados, ventanas):
+    """
+    Une los resultados de las particiones en el orden del cálculo en un solo
+    proceso: datos por ventana (orden de ventanas_analisis) y sitio, semana
+    ideal por ventana y sitio (orden del groupby).
+    """
+    orden_ventana = {analisis: i for i, analisis in enumerate(ventanas)}
+    datos = pd.concat([r[0] for r in resultados], ignore_index=True)
+    datos = datos.sort_values(
+        ["Analisis", "SiteID"], kind="stable",
+        key=lambda c: c.astype(object).map(orden_ventana) if c.name == "Analisis" else c
+    )
+    semanas = pd.concat([r[1] for r in resultados], ignore_index=True)
+    semanas = semanas.sort_values(["Analisis", "SiteID"], kind="stable")
+    return datos.reset_index(drop=True), semanas.reset_index(drop=True)
 
-    # Concatenar resultados y guardar en la base de datos
-    final_data = pd.concat(results, ignore_index=True)
-    final_data["Grafico"] = "Data"
-    final_weeks = pd.concat(weeks, ignore_index=True)
-    final_weeks["Grafico"] = "Promedios"
+def calcular_consumo(conn, completo=False, workers=1, ligero=False):
+    """
+    Consumo y tráfico diarios por sitio y etapa, con límites de ±20%,
+    interpolación y semana ideal, para todas las ventanas de
+    ventanas_analisis en una sola pasada: cada fila diaria lleva su ventana
+    (Analisis) y todos los agrupamientos la incluyen como clave. Agregar una
+    ventana (p.ej. una banda tarifaria) es agregar una fila a VENTANAS_ANALISIS.
+    Solo recalcula los sitios con datos o etapas nuevas desde la última
+    ejecución (sitios_pendientes) y reemplaza sus filas; con completo=True,
+    o si aún no existen las tablas de salida, recalcula todo.
+    - workers > 1: reparte los sitios en particiones por hash del SiteID; cada
+      proceso lee de la base solo sus sitios y los calcula, y el proceso
+      principal une los resultados para una sola escritura. Los procesos ven
+      solo lo confirmado: las etapas anteriores deben haber hecho commit.
+    - ligero=True: etiquetas como category, valores en float32 y sin columnas
+      auxiliares de límites durante el cálculo (menos memoria con historia completa).
+    """
+    # Leer datos una sola vez: el resumen diario ya trae el promedio horario por día y ventana
+    print("Leyendo datos desde la base de datos...")
+    cambios = conn.total_changes
+    asegurar_resumen_diario(conn)
+    completo = completo or not all(_existe_tabla(conn, t) for t in ("data", "semana_ideal", "promedio_etapas"))
+    sitios = None if completo else leer_pendientes(conn, "consumo")
+    if sitios == []:
+        print("No hay sitios con datos nuevos; 'data' y 'semana_ideal' ya están al día.")
+        actualizar_etapas(conn, sitios)
+        return
+    if sitios is not None:
+        print(f"Recalculando {len(sitios)} sitios con datos nuevos...")
+    ventanas = leer_ventanas(conn)
+    print(f"Procesando datos para análisis: {', '.join(ventanas)}...")
+
+    particiones = []
+    # Los procesos leen la base con su propia conexión y solo ven lo confirmado:
+    # si el resumen diario se acaba de escribir dentro de la transacción de la
+    # etapa, se calcula en este proceso
+    sin_confirmar = conn.in_transaction and conn.total_changes != cambios
+    if sin_confirmar and workers > 1:
+        print("Resumen diario recién escrito sin confirmar: cálculo en un solo proceso.")
+    if workers > 1 and _ruta_base(conn) and not sin_confirmar:
+        if sitios is None:
+            sitios_calculo = [row[0] for row in conn.execute("SELECT DISTINCT SiteID FROM resumen_diario")]
+        else:
+            sitios_calculo = sitios
+        particiones = particionar_sitios(sitios_calculo, workers)
+
+    if len(particiones) > 1:
+        print(f"Procesando {len(sitios_calculo)} sitios en {len(particiones)} procesos...")
+        with ProcessPoolExecutor(max_workers=len(particiones)) as executor:
+            resultados = list(executor.map(_consumo_particion, repeat(_ruta_base(conn)), particiones, repeat(ligero)))
+        final_data, final_weeks = _unir_particiones(resultados, ventanas)
+    else:
+        if sitios is not None:
+            _sitios_calculo(conn, sitios)
+        final_data, final_weeks = _procesar_consumo(*_leer_consumo(conn, filtrar=sitios is not None, ligero=ligero), ligero=ligero)
 
     final_data = pd.concat([final_data, final_weeks], ignore_index=True)
+    if ligero:
+        # Las categorías de cada parte difieren (Grafico, sitios por partición)
+        aligerar(final_data)
+        aligerar(final_weeks)
+
+    if sitios is None:
+        escribir_tabla(conn, final_data, "data")
+        escribir_tabla(conn, final_weeks, "semana_ideal")
+    else:
+        reemplazar_filas(conn, final_data, "data", "SiteID", sitios)
+        reemplazar_filas(conn, final_weeks, "semana_ideal", "SiteID", sitios)
 
-    final_data.to_sql("data", conn, if_exists="replace", index=False)
-    final_weeks.to_sql("semana_ideal", conn, if_exists="replace", index=False)
-
-    actualizar_etapas(conn)
+    actualizar_etapas(conn, sitios)
+    with transaccion(conn):
+        limpiar_pendientes(conn, "consumo", sitios)
 
     print("Datos de consumo guardados en 'data'.")
     print("Semana ideal guardada en 'semana_ideal'.")
 
-def actualizar_etapas(conn):
+# Regla de outlier: aumento máximo del consumo de una etapa posterior al swap
+# respecto de "Sin Swap", por ventana de análisis (0.10 = hasta 10% más).
+# Las ventanas que no figuran no se evalúan; actualizar_etapas avisa si una
+# ventana con umbral no está definida en ventanas_analisis.
+UMBRALES_OUTLIER = {VENTANA_REFERENCIA: 0.0}
+
+def detectar_outliers(promedio_etapas, umbrales=None):
+    """
+    Sitios con alguna etapa posterior al swap cuyo consumo supera al de su
+    etapa "Sin Swap" de la misma ventana en más del umbral de esa ventana.
+    Se compara todo promedio_etapas a la vez: la base de cada (Analisis,
+    SiteID) se repite en sus filas con un transform.
+    """
+    umbrales = UMBRALES_OUTLIER if umbrales is None else umbrales
+    datos = promedio_etapas[promedio_etapas["Analisis"].isin(list(umbrales))]
+    es_base = datos["Etapa"] == ETAPA_SIN_SWAP
+    base = datos["Consumption"].where(es_base).groupby([datos["Analisis"], datos["SiteID"]]).transform("first")
+    limite = base * (1 + datos["Analisis"].map(umbrales).astype(float))
+    supera = ~es_base & (datos["Consumption"] > limite)
+    return datos.loc[supera, "SiteID"].unique().tolist()
+
+def actualizar_etapas(conn, sitios=None, umbrales=None):
+    """
+    Promedios por sitio y etapa (promedio_etapas) con la marca de outlier, y
+    columnas de etapas presentes y Outlier en SiteInfo. Con `sitios` solo
+    recalcula esos sitios en promedio_etapas (lista vacía: ninguno); SiteInfo
+    siempre se actualiza desde la tabla completa. `umbrales`: regla de
+    outlier por ventana (por defecto UMBRALES_OUTLIER). Las etapas presentes
+    se toman de la ventana de referencia (ventana_referencia).
+    """
+    ventanas = leer_ventanas(conn)
+    umbrales = UMBRALES_OUTLIER if umbrales is None else umbrales
+    sin_definir = [ventana for ventana in umbrales if ventana not in ventanas]
+    if sin_definir:
+        print(f"⚠️ Umbrales de outlier para ventanas no definidas en ventanas_analisis (no se evalúan): {', '.join(sin_definir)}")
+
     # Leer datos de la tabla semana_ideal
-    semana_ideal = pd.read_sql_query("SELECT * FROM semana_ideal", conn)
+    if sitios is None:
+        semana_ideal = pd.read_sql_query("SELECT * FROM semana_ideal", conn)
+    else:
+        _sitios_calculo(conn, sitios)
+        semana_ideal = pd.read_sql_query("SELECT * FROM semana_ideal WHERE SiteID IN (SELECT SiteID FROM _sitios_calculo)", conn)
     site_info = pd.read_sql_query("SELECT * FROM SiteInfo", conn)
     
     # Calcular promedio de consumo y tráfico por sitio y etapa
@@ -580,49 +1839,131 @@ def actualizar_etapas(conn):
     }).reset_index()
     
     # Detectar sitios fuera de lo normal (OUTLIER)
-    outlier_sites = []
-    for site in promedio_etapas["SiteID"].unique():
-        site_data = promedio_etapas[promedio_etapas["SiteID"] == site]
-        etapas_swap = site_data[site_data["Etapa"] != "SinSwap"]
-        
-        if not etapas_swap.empty:
-            consumo_antes = site_data[site_data["Etapa"] == "SinSwap"]["Consumption"].values
-            consumo_despues = etapas_swap["Consumption"].values
-            
-            if consumo_antes.size > 0 and any(consumo_despues > consumo_antes[0]):
-                outlier_sites.append(site)
-    
-    promedio_etapas["Outlier"] = promedio_etapas["SiteID"].apply(lambda x: "Si" if x in outlier_sites else "No")
+    outlier_sites = detectar_outliers(promedio_etapas, umbrales)
+    promedio_etapas["Outlier"] = np.where(promedio_etapas["SiteID"].isin(outlier_sites), "Si", "No")
     
     # Guardar la tabla con promedios en la base de datos
-    promedio_etapas.to_sql("promedio_etapas", conn, if_exists="replace", index=False, chunksize=2000)
+    if sitios is None:
+        escribir_tabla(conn, promedio_etapas, "promedio_etapas")
+    else:
+        if sitios:
+            reemplazar_filas(conn, promedio_etapas, "promedio_etapas", "SiteID", sitios)
+        promedio_etapas = pd.read_sql_query("SELECT * FROM promedio_etapas", conn)
+        outlier_sites = promedio_etapas.loc[promedio_etapas["Outlier"] == "Si", "SiteID"].unique().tolist()
     
     # Identificar qué etapas están presentes en cada sitio
-    etapas_disponibles = promedio_etapas[promedio_etapas["Analisis"] == "24h"].pivot(index="SiteID", columns="Etapa", values="Consumption").notna().astype(str)
+    referencia = ventana_referencia(ventanas)
+    etapas_disponibles = promedio_etapas[promedio_etapas["Analisis"] == referencia].pivot(index="SiteID", columns="Etapa", values="Consumption").notna().astype(str)
     etapas_disponibles.replace({"True": "Si", "False": "No"}, inplace=True)
     
     # Actualizar SiteInfo con columnas indicando presencia de etapas y marcando outliers
+    # (reemplaza las de una actualización anterior)
+    site_info = site_info.drop(columns=[c for c in site_info.columns if c in etapas_disponibles.columns or c == "Outlier"])
     site_info = site_info.merge(etapas_disponibles, on="SiteID", how="left")
-    site_info["Outlier"] = site_info["SiteID"].apply(lambda x: "Si" if x in outlier_sites else "No")
+    site_info["Outlier"] = np.where(site_info["SiteID"].isin(outlier_sites), "Si", "No")
     
     # Guardar la tabla actualizada en la base de datos
-    site_info.to_sql("SiteInfo", conn, if_exists="replace", index=False, chunksize=2000)
+    escribir_tabla(conn, site_info, "SiteInfo")
     
     print("Tabla 'promedio_etapas' creada y datos actualizados en 'SiteInfo'. Se han identificado outliers.")
 
-def analisis_cluster(conn): 
+# Comparaciones de ahorro declaradas: (etapa, etapa base, nombre de la comparación).
+# Además, cada etapa se compara siempre con ETAPA_SIN_SWAP ("<Etapa> vs Sin Swap").
+COMPARACIONES_AHORRO = [
+    ("Swap 3 Legacy + PrSc", "Swap 3 Legacy", "Nuevo Feature vs Swap 3 Legacy"),
+]
+METRICAS_AHORRO = ["Consumption", "TrafficData", "kWperGB"]
+# Nombres con que ahorro_etapas_sitios guarda la etapa comparada contra Sin Swap
+# de cada métrica (Etapa_<métrica> en calcular_ahorros); los leen los reportes
+COLUMNAS_LEGADO_AHORRO = {"Etapa_Consumption": "Etapa_x", "Etapa_TrafficData": "Etapa_y", "Etapa_kWperGB": "Etapa"}
+
+def calcular_ahorros(promedio_sitios, comparaciones=None):
+    """
+    Ahorro (base - etapa) / base de cada comparación de etapas, para todas las
+    métricas y sitios a la vez. promedio_sitios se pivota a una fila por
+    (Analisis, SiteID) con una columna por etapa y cada comparación toma dos
+    columnas del pivote. Una métrica solo se informa si la etapa y su base
+    tienen valor; queda una fila por (Analisis, SiteID, Etapas_comparadas)
+    con al menos una métrica comparable. Etapa_<métrica> es la etapa de las
+    comparaciones contra Sin Swap con esa métrica comparable.
+    """
+    comparaciones = COMPARACIONES_AHORRO if comparaciones is None else comparaciones
+    pivote = (
+        promedio_sitios.astype({"Etapa": object})
+        .set_index(["Analisis", "SiteID", "Etapa"])[METRICAS_AHORRO]
+        .unstack("Etapa")
+    )
+    etapas = [e for e in pivote.columns.get_level_values("Etapa").unique() if e != ETAPA_SIN_SWAP]
+    pares = {f"{e} vs {ETAPA_SIN_SWAP}": (e, ETAPA_SIN_SWAP) for e in etapas}
+    pares.update({nombre: (etapa, base) for etapa, base, nombre in comparaciones})
+    nombres = list(pares)
+    etapa = [e for e, _ in pares.values()]
+    base = [b for _, b in pares.values()]
+    contra_sin_swap = np.tile([b == ETAPA_SIN_SWAP for b in base], len(pivote))
+
+    resultado = {
+        "Analisis": np.repeat(pivote.index.get_level_values("Analisis").to_numpy(dtype=object), len(nombres)),
+        "SiteID": np.repeat(pivote.index.get_level_values("SiteID").to_numpy(dtype=object), len(nombres)),
+        "Etapas_comparadas": np.tile(np.array(nombres, dtype=object), len(pivote))
+    }
+    etapa_fila = np.tile(np.array(etapa, dtype=object), len(pivote))
+    alguna = np.zeros(len(etapa_fila), dtype=bool)
+    for metrica in METRICAS_AHORRO:
+        valores = pivote[metrica].reindex(columns=etapa).to_numpy(dtype="float64").ravel()
+        bases = pivote[metrica].reindex(columns=base).to_numpy(dtype="float64").ravel()
+        comparable = ~np.isnan(valores) & ~np.isnan(bases)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ahorro = (bases - valores) / bases
+        resultado[f"Etapa_{metrica}"] = np.where(comparable & contra_sin_swap, etapa_fila, None)
+        resultado[metrica] = np.where(comparable, valores, np.nan)
+        resultado[f"{metrica}_base"] = np.where(comparable, bases, np.nan)
+        resultado[f"Ahorro_{metrica}"] = np.where(comparable, ahorro, np.nan)
+        alguna |= comparable
+
+    # Mismo orden de filas y columnas que la versión con merges por métrica
+    columnas = ["SiteID"]
+    for i, metrica in enumerate(METRICAS_AHORRO):
+        columnas += [f"Etapa_{metrica}", metrica, f"{metrica}_base"]
+        columnas += ["Etapas_comparadas", f"Ahorro_{metrica}"] if i == 0 else [f"Ahorro_{metrica}"]
+    ahorros = pd.DataFrame(resultado)[columnas + ["Analisis"]][alguna]
+    return ahorros.sort_values(["Analisis", "SiteID", "Etapas_comparadas"], kind="stable").reset_index(drop=True)
+
+def analisis_cluster(conn, completo=False, ligero=False):
+    """
+    Semana ideal por cluster y ahorros por sitio y por cluster. Solo recalcula
+    los clusters de los sitios pendientes (y los que perdieron sitios): lee
+    la semana ideal de sus sitios y reemplaza sus filas. Con completo=True, o
+    si aún no existen las tablas de salida, recalcula todo.
+    ligero=True: semana ideal con etiquetas category y valores en float32.
+    """
     print("Leyendo datos de la base de datos...")
+    tablas_salida = ("semana_ideal_cluster", "ahorro_etapas_sitios", "ahorro_cluster")
+    completo = completo or not all(_existe_tabla(conn, t) for t in tablas_salida)
+    sitios = None if completo else leer_pendientes(conn, "cluster")
 
     # Leer SiteInfo y semana_ideal solo una vez
     site_info = pd.read_sql_query("SELECT SiteID, Cluster FROM SiteInfo", conn)
-    semana_ideal = pd.read_sql_query("SELECT * FROM semana_ideal", conn)
-
-    # Almacenar resultados de ambos análisis
+    if sitios is None:
+        semana_ideal = pd.read_sql_query("SELECT * FROM semana_ideal", conn)
+    else:
+        clusters = set(site_info.loc[site_info["SiteID"].isin(sitios), "Cluster"].dropna().astype(str))
+        clusters |= {row[0] for row in conn.execute("SELECT Cluster FROM clusters_pendientes")}
+        if not sitios and not clusters:
+            print("No hay sitios ni clusters con cambios; las tablas de clusters ya están al día.")
+            return None
+        # Todos los sitios de los clusters afectados, para rehacer sus agregados completos
+        miembros = sorted(set(sitios) | set(site_info.loc[site_info["Cluster"].astype(str).isin(clusters), "SiteID"]))
+        print(f"Recalculando {len(clusters)} clusters ({len(miembros)} sitios)...")
+        _sitios_calculo(conn, miembros)
+        semana_ideal = pd.read_sql_query("SELECT * FROM semana_ideal WHERE SiteID IN (SELECT SiteID FROM _sitios_calculo)", conn)
+    if ligero:
+        aligerar(semana_ideal, ["Consumption", "TrafficData", "kWperGB"])
+
+    # Almacenar resultados de todas las ventanas de análisis (las mismas de calcular_consumo)
+    ventanas = leer_ventanas(conn)
     resultados_cluster = []
-    resultados_ahorro_sitios = []
-    resultados_ahorro_cluster = []
 
-    for tipo_de_analisis in ["24h", "Nocturno"]:
+    for tipo_de_analisis in ventanas:
         print(f"Procesando análisis de clusters para: {tipo_de_analisis}...")
 
         # Filtrar la tabla semana_ideal según el tipo de análisis
@@ -633,88 +1974,282 @@ def analisis_cluster(conn):
 
         # **Semana ideal por Cluster y Etapa**
         semana_ideal_cluster = (
-            semana_ideal_filtrada.groupby(["Cluster", "Etapa", "DayOfWeek"])
-            .apply(lambda x: x.sort_values("Consumption").iloc[1:-1] if len(x) > 3 else x)
-            .groupby(level=["Cluster", "Etapa", "DayOfWeek"])
+            est.recortar_por_valor(semana_ideal_filtrada, ["Cluster", "Etapa", "DayOfWeek"], "Consumption", est.NIVELES_MIN_MAX)
+            .groupby(["Cluster", "Etapa", "DayOfWeek"], observed=True)
             .agg({"Consumption": "mean", "TrafficData": "mean", "kWperGB": "mean"})
             .reset_index()
         )
         semana_ideal_cluster["Analisis"] = tipo_de_analisis
         resultados_cluster.append(semana_ideal_cluster)
 
-        # **Promedio de cada sitio en cada etapa**
-        promedio_sitios = (
-            semana_ideal_filtrada.groupby(["SiteID", "Etapa"])
-            .agg({"Consumption": "mean", "TrafficData": "mean", "kWperGB": "mean"})
-            .reset_index()
-        )
-         ## Resultado esperado: ['SiteID', 'Etapa', 'Consumption', 'TrafficData', 'kWperGB']
-
-        # **Cálculo del ahorro por etapa**
-        ahorro_etapas = []
-        i=1
-
-        for tipo in ['Consumption', 'TrafficData', 'kWperGB']:
-
-            ahorros = []
-            sin_swap = promedio_sitios[(promedio_sitios['Etapa'] == 'Sin Swap') & (promedio_sitios[f"{tipo}"].notna())] [['SiteID', f"{tipo}"]]
-            etapas = promedio_sitios[(promedio_sitios['Etapa'] != 'Sin Swap') & (promedio_sitios[f"{tipo}"].notna())] [['SiteID', 'Etapa', f"{tipo}"]]
-            ahorros = pd.merge(etapas, sin_swap, on=['SiteID'], suffixes=('', '_base'), how='inner')
-            # Resultado esperado: ['SiteID', 'Etapa', 'Consumption', 'Consumption_base']
-            ahorros['Etapas_comparadas'] = ahorros['Etapa'] + ' vs Sin Swap'
-            ahorros[f"Ahorro_{tipo}"]=(ahorros[f"{tipo}_base"] - ahorros[f"{tipo}"]) / ahorros[f"{tipo}_base"]
-            # Resultado esperado ['SiteID', 'Etapa', 'Consumption', 'Consumption_base', 'Etapas comparadas', 'Ahorro_Consumption']
-            
-            swap_legacy_ps = promedio_sitios[(promedio_sitios['Etapa'] == 'Swap 3 Legacy + PrSc') & (promedio_sitios[f"{tipo}"].notna())] [['SiteID', f"{tipo}"]]
-            swap_legacy = promedio_sitios[(promedio_sitios['Etapa'] == 'Swap 3 Legacy') & (promedio_sitios[f"{tipo}"].notna())] [['SiteID', f"{tipo}"]]
-            ahorros_2 = pd.merge(swap_legacy_ps,swap_legacy, on=['SiteID'], suffixes=('', '_base'), how='inner')
-            ahorros_2['Etapas_comparadas'] = 'Nuevo Feature vs Swap 3 Legacy'
-            ahorros_2[f"Ahorro_{tipo}"]=(ahorros_2[f"{tipo}_base"] - ahorros_2[f"{tipo}"]) / ahorros_2[f"{tipo}_base"]
-
-            ahorros = pd.concat([ahorros, ahorros_2], ignore_index=True)
-
-            if i==1:
-                ahorro_etapas = ahorros
-            else:                
-                ahorro_etapas=pd.merge(ahorro_etapas,ahorros, on=['SiteID','Etapas_comparadas'], how='outer')
-            i = i+1
-
-        ahorro_etapas_df = pd.DataFrame(ahorro_etapas)
-        ahorro_etapas_df["Analisis"] = tipo_de_analisis
-        resultados_ahorro_sitios.append(ahorro_etapas_df) 
-
-        # **Cálculo del ahorro por Cluster**
-        ahorro_cluster = ahorro_etapas_df.merge(site_info, on="SiteID", how="left")
-        ahorro_cluster = (
-            ahorro_cluster.groupby(["Cluster", "Etapa"])
-            .agg({
-            "Ahorro_kWperGB": "mean",
-            "Ahorro_TrafficData": "mean",
-            "Ahorro_Consumption": "mean"
-            })
-            .reset_index()
-        )
-        ahorro_cluster["Analisis"] = tipo_de_analisis
-        resultados_ahorro_cluster.append(ahorro_cluster)
+    # **Promedio de cada sitio en cada etapa**, todas las ventanas a la vez
+    semana_ideal = semana_ideal[semana_ideal["Analisis"].isin(ventanas)]
+    promedio_sitios = (
+        semana_ideal.groupby(["Analisis", "SiteID", "Etapa"], observed=True)
+        .agg({"Consumption": "mean", "TrafficData": "mean", "kWperGB": "mean"})
+        .reset_index()
+    )
+
+    # **Cálculo del ahorro por etapa**: todas las comparaciones y métricas de una vez
+    ahorro_etapas_sitios_final = calcular_ahorros(promedio_sitios)
+
+    # **Cálculo del ahorro por Cluster**
+    ahorro_cluster_final = (
+        ahorro_etapas_sitios_final.merge(site_info, on="SiteID", how="left")
+        .rename(columns={"Etapa_kWperGB": "Etapa"})
+        .groupby(["Analisis", "Cluster", "Etapa"], observed=True)
+        .agg({
+        "Ahorro_kWperGB": "mean",
+        "Ahorro_TrafficData": "mean",
+        "Ahorro_Consumption": "mean"
+        })
+        .reset_index()
+    )
+    ahorro_cluster_final = ahorro_cluster_final[[c for c in ahorro_cluster_final.columns if c != "Analisis"] + ["Analisis"]]
 
-    # **Concatenar resultados de ambos análisis y guardar en la base**
+    # **Concatenar resultados de todas las ventanas y guardar en la base**
     semana_ideal_cluster_final = pd.concat(resultados_cluster, ignore_index=True)
-    ahorro_etapas_sitios_final = pd.concat(resultados_ahorro_sitios, ignore_index=True)
-    ahorro_cluster_final = pd.concat(resultados_ahorro_cluster, ignore_index=True)
+    ahorro_etapas_sitios_final = ahorro_etapas_sitios_final.rename(columns=COLUMNAS_LEGADO_AHORRO)
 
-    semana_ideal_cluster_final.to_sql("semana_ideal_cluster", conn, if_exists="replace", index=False, chunksize=5000)
-    ahorro_etapas_sitios_final.to_sql("ahorro_etapas_sitios", conn, if_exists="replace", index=False, chunksize=5000)
-    ahorro_cluster_final.to_sql("ahorro_cluster", conn, if_exists="replace", index=False, chunksize=5000)
+    if sitios is None:
+        escribir_tabla(conn, semana_ideal_cluster_final, "semana_ideal_cluster")
+        escribir_tabla(conn, ahorro_etapas_sitios_final, "ahorro_etapas_sitios")
+        escribir_tabla(conn, ahorro_cluster_final, "ahorro_cluster")
+    else:
+        reemplazar_filas(conn, semana_ideal_cluster_final, "semana_ideal_cluster", "Cluster", sorted(clusters))
+        reemplazar_filas(conn, ahorro_etapas_sitios_final, "ahorro_etapas_sitios", "SiteID", miembros)
+        reemplazar_filas(conn, ahorro_cluster_final, "ahorro_cluster", "Cluster", sorted(clusters))
+
+    with transaccion(conn):
+        limpiar_pendientes(conn, "cluster", sitios)
+        conn.execute("DELETE FROM clusters_pendientes")
 
     print("Tablas 'semana_ideal_cluster', 'ahorro_etapas_sitios' y 'ahorro_cluster' creadas exitosamente.")
 
     return semana_ideal_cluster_final, ahorro_etapas_sitios_final, ahorro_cluster_final
 
-def analisis_tarifas(conn, data_folder):
+# Cubos de agregados: tabla de hechos, claves propias y métricas. Cada cubo
+# guarda suma y cantidad de cada métrica por sus claves y DIMENSIONES_CUBO.
+CUBOS = {
+    "cubo_semana_ideal": ("semana_ideal", ["Analisis", "Etapa", "DayOfWeek"], ["Consumption", "TrafficData", "kWperGB"]),
+    "cubo_ahorro": ("ahorro_etapas_sitios", ["Analisis", "Etapas_comparadas"], ["Ahorro_Consumption", "Ahorro_TrafficData", "Ahorro_kWperGB"]),
+}
+
+def construir_cubos(conn, dimensiones=None):
+    """
+    Reconstruye los cubos de CUBOS con una agregación SQL sobre sus hechos
+    unidos a SiteInfo: una fila por combinación de claves y dimensiones con
+    Filas, Suma_<métrica> y N_<métrica> (valores no nulos). Cualquier corte
+    por un subconjunto de dimensiones se obtiene sumando filas del cubo
+    (consultar_cubo), sin recalcular el análisis. Los promedios son simples:
+    no aplican los recortes de semana_ideal_cluster.
+    """
+    dimensiones = DIMENSIONES_CUBO if dimensiones is None else dimensiones
+    columnas_sitio = {row[1] for row in conn.execute('PRAGMA table_info("SiteInfo")')}
+    dimensiones = [d for d in dimensiones if d in columnas_sitio]
+
+    for cubo, (hechos, claves, metricas) in CUBOS.items():
+        if not _existe_tabla(conn, hechos):
+            print(f"⚠️ Cubo '{cubo}' omitido: no existe la tabla '{hechos}'")
+            continue
+        inicio = time.perf_counter()
+        staging = f"{cubo}__nueva"
+        grupo = [f'h."{c}"' for c in claves] + [f'i."{d}"' for d in dimensiones]
+        agregados = ["COUNT(*) AS Filas"]
+        for metrica in metricas:
+            agregados += [f'SUM(h."{metrica}") AS "Suma_{metrica}"', f'COUNT(h."{metrica}") AS "N_{metrica}"']
+
+        with transaccion(conn):
+            conn.execute(f'DROP TABLE IF EXISTS "{staging}"')
+            conn.execute(f"""
+                CREATE TABLE "{staging}" AS
+                SELECT {", ".join(grupo)}, {", ".join(agregados)}
+                FROM "{hechos}" AS h
+                LEFT JOIN SiteInfo AS i ON i.SiteID = h.SiteID
+                GROUP BY {", ".join(grupo)}
+            """)
+            conn.execute(f'DROP TABLE IF EXISTS "{cubo}"')
+            conn.execute(f'ALTER TABLE "{staging}" RENAME TO "{cubo}"')
+
+        filas = conn.execute(f'SELECT COUNT(*) FROM "{cubo}"').fetchone()[0]
+        print(f"🧊 Cubo '{cubo}': {filas} filas por {', '.join(claves + dimensiones)} en {time.perf_counter() - inicio:.2f}s")
+        recrear_indices(conn, [cubo])
+
+def consultar_cubo(conn, dimensiones, filtros=None, cubo="cubo_semana_ideal"):
+    """
+    Promedio de cada métrica del cubo agrupado por `dimensiones` (cualquier
+    subconjunto de sus claves y dimensiones; lista vacía = total), sumando
+    las sumas y cantidades parciales. `filtros`: {dimensión: valor o lista
+    de valores}; None filtra los vacíos.
+    Ejemplo: consultar_cubo(conn, ["Departamento", "Etapa"], {"Analisis": "24h"})
+    """
+    filtros = filtros or {}
+    columnas = [row[1] for row in conn.execute(f'PRAGMA table_info("{cubo}")')]
+    if not columnas:
+        raise ValueError(f"No existe el cubo '{cubo}'; ejecutar construir_cubos")
+    metricas = [c[len("Suma_"):] for c in columnas if c.startswith("Suma_")]
+    disponibles = [c for c in columnas if c != "Filas" and not c.startswith(("Suma_", "N_"))]
+    desconocidas = [d for d in list(dimensiones) + list(filtros) if d not in disponibles]
+    if desconocidas:
+        raise ValueError(f"Dimensiones no disponibles en '{cubo}': {', '.join(desconocidas)} (hay: {', '.join(disponibles)})")
+
+    condiciones = []
+    parametros = []
+    for dimension, valor in filtros.items():
+        if valor is None:
+            condiciones.append(f'"{dimension}" IS NULL')
+        elif isinstance(valor, (list, tuple, set)):
+            condiciones.append(f'"{dimension}" IN ({", ".join("?" * len(valor))})')
+            parametros.extend(valor)
+        else:
+            condiciones.append(f'"{dimension}" = ?')
+            parametros.append(valor)
+
+    columnas_grupo = ", ".join(f'"{d}"' for d in dimensiones)
+    seleccion = [f'"{d}"' for d in dimensiones] + ["SUM(Filas) AS Filas"]
+    seleccion += [f'SUM("Suma_{m}") / SUM("N_{m}") AS "{m}"' for m in metricas]
+    consulta = f'SELECT {", ".join(seleccion)} FROM "{cubo}"'
+    if condiciones:
+        consulta += " WHERE " + " AND ".join(condiciones)
+    if dimensiones:
+        consulta += f" GROUP BY {columnas_grupo} ORDER BY {columnas_grupo}"
+    return pd.read_sql_query(consulta, conn, params=parametros)
+
+# Prioridad de cada fuente de facturas ("Reporte1", "Reporte2"... cuentan como
+# "Reporte"): una factura reemplaza a la guardada con la misma clave
+# (ID_Suministro, AñoMes) solo si su prioridad es mayor o igual
+PRIORIDAD_FUENTE = {"Evolutivo": 1, "Reporte": 2, "Manual": 3}
+
+# Columnas de cada factura en el almacén `tarifas`; las derivadas se recalculan por suministro
+COLUMNAS_TARIFA = ["SiteID", "SUMINISTRO_ACTUAL", "DISTRIBUIDOR", "PROVEEDOR", "Tipo_Tarifa", "AñoMes", "Tarifa", "ID_Suministro", "Fuente", "Prioridad"]
+COLUMNAS_DERIVADAS_TARIFA = ["Periodo", "Tarifa_ajustada", "PeriodosDisponibles"]
+
+def prioridad_fuente(fuente):
+    """Prioridad (PRIORIDAD_FUENTE) de cada valor de Fuente; 0 si no se reconoce."""
+    fuente = fuente.astype(str).str.replace(r"\d+$", "", regex=True)
+    return fuente.map(PRIORIDAD_FUENTE).fillna(0).astype(int)
+
+def deduplicar_tarifas(tarifas):
+    """
+    Una factura por (ID_Suministro, AñoMes): la de mayor Prioridad y, entre
+    iguales, la última de `tarifas`. Descarta las que no tienen ID_Suministro
+    (no se pueden asignar a un suministro) y deja AñoMes como entero.
+    """
+    tarifas = tarifas.dropna(subset=["ID_Suministro"]).copy()
+    tarifas["AñoMes"] = tarifas["AñoMes"].astype(int)
+    if "Prioridad" not in tarifas.columns:
+        tarifas["Prioridad"] = prioridad_fuente(tarifas["Fuente"])
+    tarifas = tarifas.sort_values("Prioridad", kind="stable")
+    tarifas = tarifas.drop_duplicates(subset=["ID_Suministro", "AñoMes"], keep="last")
+    return tarifas.sort_index()[COLUMNAS_TARIFA].reset_index(drop=True)
+
+def _almacen_tarifas_listo(conn):
+    """True si `tarifas` tiene Prioridad y el índice único de su clave (admite upserts)."""
+    if not _existe_tabla(conn, "tarifas"):
+        return False
+    columnas = {row[1] for row in conn.execute('PRAGMA table_info("tarifas")')}
+    indice = conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='ux_tarifas_ID_Suministro_AñoMes'").fetchone()
+    return "Prioridad" in columnas and indice is not None
+
+def upsert_tarifas(conn, tarifas):
+    """
+    Inserta en `tarifas` las facturas nuevas y reemplaza las guardadas con la
+    misma clave (ID_Suministro, AñoMes) si su Prioridad es mayor o igual.
+    Las columnas derivadas de las filas reemplazadas no cambian: se recalculan
+    después por suministro. Devuelve los ID_Suministro con facturas
+    insertadas o reemplazadas. No hace commit.
+    """
+    columnas_sql = ", ".join(f'"{c}"' for c in COLUMNAS_TARIFA)
+    tipos = [_tipo_sql(tarifas[c]) for c in COLUMNAS_TARIFA]
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS _tarifas_nuevas ({columnas_sql})")
+    conn.execute("DELETE FROM _tarifas_nuevas")
+    conn.executemany(f'INSERT INTO _tarifas_nuevas VALUES ({", ".join("?" * len(COLUMNAS_TARIFA))})', _filas_sql(tarifas[COLUMNAS_TARIFA], tipos))
+
+    afectados = [row[0] for row in conn.execute("""
+        SELECT DISTINCT n.ID_Suministro
+        FROM _tarifas_nuevas n
+        LEFT JOIN tarifas t ON t.ID_Suministro = n.ID_Suministro AND t."AñoMes" = n."AñoMes"
+        WHERE t.ID_Suministro IS NULL OR n.Prioridad >= t.Prioridad
+        ORDER BY n.ID_Suministro
+    """)]
+    actualizar = ", ".join(f'"{c}" = excluded."{c}"' for c in COLUMNAS_TARIFA if c not in ("ID_Suministro", "AñoMes"))
+    conn.execute(f"""
+        INSERT INTO tarifas ({columnas_sql})
+        SELECT {columnas_sql} FROM _tarifas_nuevas WHERE true
+        ON CONFLICT (ID_Suministro, "AñoMes") DO UPDATE SET {actualizar}
+        WHERE excluded.Prioridad >= tarifas.Prioridad
+    """)
+    print(f"🧾 Tarifas: {len(tarifas)} facturas nuevas, {len(afectados)} suministros con cambios")
+    return afectados
+
+def _suministros_calculo(conn, suministros):
+    """Carga `suministros` en la tabla temporal _suministros_calculo para filtrar consultas."""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _suministros_calculo (ID_Suministro TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM _suministros_calculo")
+    conn.executemany("INSERT OR IGNORE INTO _suministros_calculo VALUES (?)", ((s,) for s in suministros))
+
+def periodo_tarifa(tarifas, fechas_swap):
+    """
+    Periodo de cada factura según el mes de FechaFinSwap de su sitio
+    (`fechas_swap`, Series indexada por SiteID): ANTES_SWAP, EN_SWAP,
+    POST_SWAP o SIN_SWAP si el sitio no tiene fecha de swap.
+    """
+    # Comparar solo año y mes (formato YYYYMM)
+    fecha_swap = pd.to_datetime(tarifas["SiteID"].map(fechas_swap), errors="coerce")
+    mes = pd.to_datetime(tarifas["AñoMes"].astype(str), format="%Y%m").dt.strftime("%Y%m")
+    mes_swap = fecha_swap.dt.strftime("%Y%m")
+    periodo = np.where(
+        fecha_swap.isna(),
+        "SIN_SWAP",
+        np.where(mes < mes_swap, "ANTES_SWAP", np.where(mes == mes_swap, "EN_SWAP", "POST_SWAP"))
+    )
+    return pd.Series(periodo, index=tarifas.index)
+
+def calcular_tarifas(tarifas, fechas_swap):
+    """
+    Agrega a las facturas de `tarifas` (todas las de cada suministro incluido)
+    las columnas derivadas: Periodo, Tarifa_ajustada (recortada a ±30% de la
+    media sin extremos de su suministro y periodo) y PeriodosDisponibles.
+    Devuelve las filas ordenadas por ID_Suministro y AñoMes.
+    """
+    tarifas = tarifas.drop(columns=COLUMNAS_DERIVADAS_TARIFA, errors="ignore")
+    tarifas_combined_final = tarifas[["SiteID", "ID_Suministro", "AñoMes", "Tarifa"]].copy()
+    tarifas_combined_final["Periodo"] = periodo_tarifa(tarifas_combined_final, fechas_swap)
+
+    # Agrupar por ID_Suministro y unir los periodos disponibles en una nueva columna
+    periodos_disponibles = tarifas_combined_final.groupby("ID_Suministro")["Periodo"].apply(
+        lambda x: '-'.join(sorted([periodo.replace('_SWAP', '') for periodo in x.unique()]))
+    ).reset_index()
+    periodos_disponibles.rename(columns={"Periodo": "PeriodosDisponibles"}, inplace=True)
+
+    # Se convierten los valores y, en caso de error, se pasan a NaN.
+    tarifas_combined_final["Tarifa"] = pd.to_numeric(tarifas_combined_final["Tarifa"], errors="coerce")
+    tarifas_combined_final = tarifas_combined_final.dropna(subset=["Tarifa"])
+
+    # Promedio por suministro y periodo sin el valor mínimo y el máximo (si hay más de 3)
+    claves_tarifa = ["ID_Suministro", "Periodo"]
+    promedio_tarifas = est.media_recortada(tarifas_combined_final, claves_tarifa, "Tarifa", est.NIVELES_MIN_MAX)
+
+    # Recortar cada tarifa a ±30% del promedio de su grupo en una sola pasada
+    promedio = tarifas_combined_final.join(promedio_tarifas.rename("PromedioTarifa"), on=claves_tarifa)["PromedioTarifa"]
+    _, limite_inferior, limite_superior = est.limites_media(tarifas_combined_final, claves_tarifa, "Tarifa", 0.3, media=promedio)
+    tarifas_combined_final["Tarifa_ajustada"] = tarifas_combined_final["Tarifa"].clip(lower=limite_inferior, upper=limite_superior)
+
+    # El merge outer ordena por la clave (ID_Suministro, AñoMes)
+    tarifas = pd.merge(tarifas, tarifas_combined_final[["ID_Suministro", "AñoMes", "Periodo", "Tarifa_ajustada"]], on=["ID_Suministro", "AñoMes"], how="outer")
+    return tarifas.merge(periodos_disponibles, on="ID_Suministro", how="left")
+
+def analisis_tarifas(conn, data_folder, completo=False):
+    """
+    Carga las facturas de los archivos nuevos (Evolutivo, Reportes, Manual)
+    en el almacén `tarifas` con upsert por (ID_Suministro, AñoMes) según
+    PRIORIDAD_FUENTE, y recalcula Periodo, Tarifa_ajustada y
+    PeriodosDisponibles solo de los suministros con facturas nuevas o cuyo
+    sitio cambió de FechaFinSwap. Con completo=True, o si el almacén aún no
+    existe (o es de una versión sin Prioridad), reconstruye toda la tabla.
+    """
     print("Iniciando análisis de tarifas...")
 
-    processed_folder = os.path.join(data_folder, "old")
-    os.makedirs(processed_folder, exist_ok=True)
     valor_minimo = 100
 
     # Verificar si las tablas 'tarifas' y 'suministros_id' existen
@@ -735,14 +2270,6 @@ def analisis_tarifas(conn, data_folder):
         suministros_site_id_count = pd.read_sql_query("SELECT COUNT(DISTINCT SiteID) AS count FROM suministros_id", conn)["count"][0]
         print(f"La tabla 'suministros_id' existe y tiene {suministros_id_count} registros y {suministros_site_id_count} SiteID únicos.")
 
-    try:
-        tarifas_actuales = pd.read_sql_query("SELECT * FROM tarifas", conn)
-        print("Tabla tarifas leída correctamente.")
-        columns_to_drop = [col for col in tarifas_actuales.columns if col in ["Periodo_x", "Tarifa_ajustada_x", "PeriodosDisponibles_x", "Periodo_y", "Tarifa_ajustada_y", "PeriodosDisponibles_y"]]
-        tarifas_actuales.drop(columns=columns_to_drop, inplace=True)
-    except:
-        tarifas_actuales = pd.DataFrame()
-    
     # Leer tabla de IDs de suministros si ya existe
     try:
         suministros_id = pd.read_sql_query("SELECT SiteID,SUMINISTRO_ACTUAL,ID_Suministro,Tipo_Tarifa,Servicios,Outlier FROM suministros_id", conn)
@@ -751,17 +2278,20 @@ def analisis_tarifas(conn, data_folder):
         suministros_id = pd.DataFrame(columns=["SiteID", "SUMINISTRO_ACTUAL", "ID_Suministro","Tipo_Tarifa","Servicios","Outlier"])
 
     # **Identificar archivos relevantes**
-    all_files = [f for f in os.listdir(data_folder) if f.endswith(".xlsx") and "_procesado" not in f]
+    candidatos = [os.path.join(data_folder, f) for f in os.listdir(data_folder) if f.endswith(".xlsx") and "_procesado" not in f]
+    archivos = archivos_pendientes(conn, candidatos, "tarifas")
+    all_files = [os.path.basename(archivo["Ruta"]) for archivo in archivos]
     evolutivo_file = next((f for f in all_files if re.search(r"evolutivo", f, re.IGNORECASE)), None)
     report_files = [f for f in all_files if re.search(r"reporte", f, re.IGNORECASE)]
     manual_file = next((f for f in all_files if re.search(r"manual", f, re.IGNORECASE)), None)
 
     tarifas_combined = []
+    filas_por_archivo = {}
 
     # **Procesar archivo Evolutivo para actualizar la tabla de suministros**
     if evolutivo_file:
         file_path = os.path.join(data_folder, evolutivo_file)
-        evolutivo_data = pd.read_excel(file_path)
+        evolutivo_data = leer_excel(file_path)
         print(f"Archivo Evolutivo leído: {file_path}")
         evolutivo_data = evolutivo_data.rename(columns={"cod_unico_ing": "SiteID", "TARIFA": "Tipo_Tarifa", "SERVICIOS":"Servicios", "SUMINISTRO ACTUAL": "SUMINISTRO_ACTUAL"}).dropna(subset=["SiteID"])
 
@@ -778,6 +2308,7 @@ def analisis_tarifas(conn, data_folder):
         
         tarifas_data = tarifas_data.reset_index(drop=True)
         tarifas_combined.append(tarifas_data)
+        filas_por_archivo[evolutivo_file] = len(tarifas_data)
         print(f"Cantidad de sitios: {len(tarifas_data['SiteID'].unique())}")
 
         # **Limpieza de datos: Eliminar espacios en blanco de los suministros**
@@ -787,13 +2318,13 @@ def analisis_tarifas(conn, data_folder):
         # **Actualizar la tabla de suministros_id**
         suministros_id = pd.concat([suministros_id, evolutivo_data[["ID_Suministro","SiteID", "SUMINISTRO_ACTUAL","Tipo_Tarifa", "Servicios"]]], ignore_index=True)
         suministros_id = suministros_id.drop_duplicates(subset=["ID_Suministro"])
-        suministros_id.to_sql("suministros_id", conn, if_exists="replace", index=False, chunksize=5000)
+        escribir_tabla(conn, suministros_id, "suministros_id")
 
     # **Procesar archivos de Reporte de Consumo**
     i=1
     for report_file in report_files:
         file_path = os.path.join(data_folder, report_file)
-        report_data = pd.read_excel(file_path)
+        report_data = leer_excel(file_path)
         print(f"Archivo leído: {file_path}")
 
         report_data = report_data.rename(columns={
@@ -827,6 +2358,7 @@ def analisis_tarifas(conn, data_folder):
         report_data = report_data[report_data["Tarifa"] >= valor_minimo]
         report_data = report_data.reset_index(drop=True)
         tarifas_combined.append(report_data)
+        filas_por_archivo[report_file] = len(report_data)
 
         print(f"Cantidad de sitios: {len(report_data['SiteID'].unique())}")
         i = i+1
@@ -834,14 +2366,14 @@ def analisis_tarifas(conn, data_folder):
     # **Procesar archivo Manual**
     if manual_file:
         file_path = os.path.join(data_folder, manual_file)
-        manual_data = pd.read_excel(file_path)
+        manual_data = leer_excel(file_path)
         print(f"Archivo leído: {file_path}")
 
         manual_data = manual_data.rename(columns={"SITE ID": "SiteID", "SUMINISTRO ACTUAL": "SUMINISTRO_ACTUAL"}).dropna(subset=["SiteID"])
 
         manual_data = manual_data.melt(
             id_vars=["SiteID", "SUMINISTRO_ACTUAL"],
-            value_vars=[col for col in tarifas_data.columns if col.startswith("2024") or col.startswith("2025")],
+            value_vars=[col for col in manual_data.columns if str(col).startswith(("2024", "2025"))],
             var_name="AñoMes", value_name="Tarifa"
         ).dropna(subset=["Tarifa"])
         manual_data["DISTRIBUIDOR"] = "Luz del Sur"
@@ -855,114 +2387,44 @@ def analisis_tarifas(conn, data_folder):
         manual_data = manual_data[manual_data["Tarifa"] >= valor_minimo]
         manual_data = manual_data.reset_index(drop=True)
         tarifas_combined.append(manual_data)
+        filas_por_archivo[manual_file] = len(manual_data)
 
         print(f"Cantidad de sitios: {len(manual_data['SiteID'].unique())}")
 
-    # **Concatenar y verificar**
+    # **Guardar las facturas nuevas en el almacén, priorizando Manual > Reportes > Evolutivo**
     if tarifas_combined:
-        tarifas_combined_final = pd.concat(tarifas_combined, ignore_index=True)
-        frames = [
-            df
-            for df in [tarifas_actuales, tarifas_combined_final]
-            if not df.empty and not df.isna().all(axis=0).all()
-        ]
-        tarifas_actualizadas = pd.concat(frames, join="inner", ignore_index=True)
-        tarifas_actualizadas = tarifas_actualizadas.drop_duplicates(subset=["ID_Suministro", "AñoMes"], keep="last")
+        tarifas_nuevas = deduplicar_tarifas(pd.concat(tarifas_combined, ignore_index=True))
     else:
-        tarifas_actualizadas = tarifas_actuales 
+        tarifas_nuevas = pd.DataFrame(columns=COLUMNAS_TARIFA)
         print("\nNo hay nuevos datos")
 
-    # **Eliminar duplicados, priorizando Manual > Reportes > Evolutivo**
-    tarifas_actualizadas["AñoMes"] = tarifas_actualizadas["AñoMes"].astype(int)
-    tarifas_actualizadas = tarifas_actualizadas.sort_values(by=["SiteID", "AñoMes", "Fuente"], ascending=[True, True, False])
-    tarifas_actualizadas = tarifas_actualizadas.drop_duplicates(subset=["ID_Suministro", "AñoMes"], keep="first")
-    
-    print(f"La cantidad de sitios son: {len(tarifas_actualizadas['SiteID'].unique())}")
-    print("Columnas en tarifas_actualizadas:", tarifas_actualizadas.columns.tolist())
-
     site_info = pd.read_sql_query("SELECT SiteID, FechaFinSwap FROM SiteInfo", conn)
-    tarifas_combined_final = tarifas_actualizadas [["SiteID", "ID_Suministro", "AñoMes", "Tarifa" ]] 
-
-    # **Asegurar que FechaFinSwap está en formato datetime viene de la tabla site info
-    tarifas_combined_final = tarifas_combined_final.merge(site_info, how="left", on="SiteID")
-
-    # **Determinar periodos ANTES_SWAP, EN SWAP, POST_SWAP**
-    # Convertir AñoMes a datetime asegurando formato YYYYMM
-    tarifas_combined_final["AñoMes_dt"] = pd.to_datetime(
-        tarifas_combined_final["AñoMes"].astype(str), format="%Y%m"
-    )
-
-    # Asegurar que FechaFinSwap es datetime y manejar NaT
-    tarifas_combined_final["FechaFinSwap"] = pd.to_datetime(
-        tarifas_combined_final["FechaFinSwap"], errors="coerce"  # Convierte inválidos a NaT
-    )
-
-    # Convertir ambas fechas a formato AñoMes (YYYYMM) para hacer comparaciones precisas
-    tarifas_combined_final["AñoMes_str"] = tarifas_combined_final["AñoMes_dt"].dt.strftime("%Y%m")
-    tarifas_combined_final["FechaFinSwap_str"] = tarifas_combined_final["FechaFinSwap"].dt.strftime("%Y%m")
-
-    # Asignar períodos considerando solo año y mes
-    tarifas_combined_final["Periodo"] = np.where(
-        tarifas_combined_final["FechaFinSwap"].isna(),
-        "SIN_SWAP",  # Período especial para sitios sin fecha de swap
-        np.where(
-            tarifas_combined_final["AñoMes_str"] < tarifas_combined_final["FechaFinSwap_str"],
-            "ANTES_SWAP",
-            np.where(
-                tarifas_combined_final["AñoMes_str"] == tarifas_combined_final["FechaFinSwap_str"],
-                "EN_SWAP",
-                "POST_SWAP"
-            )
-        )
-    )
-
-    # Eliminar columnas auxiliares si no las necesitas
-    tarifas_combined_final.drop(columns=["AñoMes_str", "FechaFinSwap_str"], inplace=True)
-
-    # Agrupar por ID_Suministro y unir los periodos disponibles en una nueva columna
-    periodos_disponibles = tarifas_combined_final.groupby("ID_Suministro")["Periodo"].apply(
-        lambda x: '-'.join(sorted([periodo.replace('_SWAP', '') for periodo in x.unique()]))
-    ).reset_index()
-    periodos_disponibles.rename(columns={"Periodo": "PeriodosDisponibles"}, inplace=True)
+    fechas_swap = site_info.drop_duplicates(subset=["SiteID"]).set_index("SiteID")["FechaFinSwap"]
+
+    if completo or not _almacen_tarifas_listo(conn):
+        # Reconstrucción: facturas guardadas (con la prioridad de su Fuente si
+        # la tabla es anterior al almacén) más las nuevas
+        tarifas_actuales = pd.read_sql_query("SELECT * FROM tarifas", conn) if _existe_tabla(conn, "tarifas") else pd.DataFrame(columns=COLUMNAS_TARIFA)
+        if "Prioridad" not in tarifas_actuales.columns:
+            tarifas_actuales["Prioridad"] = prioridad_fuente(tarifas_actuales["Fuente"])
+        frames = [df[COLUMNAS_TARIFA] for df in [tarifas_actuales, tarifas_nuevas] if not df.empty]
+        tarifas_actualizadas = deduplicar_tarifas(pd.concat(frames, ignore_index=True)) if frames else tarifas_nuevas
+        print(f"La cantidad de sitios son: {len(tarifas_actualizadas['SiteID'].unique())}")
+        escribir_tabla(conn, calcular_tarifas(tarifas_actualizadas, fechas_swap), "tarifas")
+    else:
+        with transaccion(conn):
+            afectados = set(upsert_tarifas(conn, tarifas_nuevas))
 
-    # Se convierten los valores y, en caso de error, se pasan a NaN.
-    tarifas_combined_final["Tarifa"] = pd.to_numeric(tarifas_combined_final["Tarifa"], errors="coerce")
-    tarifas_combined_final = tarifas_combined_final.dropna(subset=["Tarifa"])
+        # Suministros cuyo sitio cambió de FechaFinSwap: sus periodos ya no corresponden
+        periodos = pd.read_sql_query('SELECT ID_Suministro, SiteID, "AñoMes", Periodo FROM tarifas', conn)
+        cambiados = periodos.loc[periodo_tarifa(periodos, fechas_swap) != periodos["Periodo"], "ID_Suministro"]
+        afectados = sorted(afectados | set(cambiados))
+        print(f"Suministros a recalcular: {len(afectados)} ({cambiados.nunique()} por cambio de FechaFinSwap)")
 
-    def calcular_promedio(grupo):
-        # Aquí 'grupo' es una Series de valores numéricos correspondientes a 'Tarifa'
-        if len(grupo) > 3:
-            # Se eliminan el valor mínimo y el máximo para evitar extremos.
-            grupo = grupo.nsmallest(n=len(grupo)-1, keep="first").nlargest(n=len(grupo)-2, keep="first")
-        return grupo.mean()
-
-    # Aplicar la función a la columna 'Tarifa' usando groupby y seleccionando la serie explícitamente.
-    promedio_tarifas = tarifas_combined_final.groupby(["ID_Suministro", "Periodo"])["Tarifa"].agg(calcular_promedio).reset_index()
-
-    def ajustar_limites(grupo, promedio_df):
-        # Extraer el promedio correspondiente al grupo actual utilizando .loc
-        promedio = promedio_df.loc[
-            (promedio_df["ID_Suministro"] == grupo.name[0]) & (promedio_df["Periodo"] == grupo.name[1]),
-            "Tarifa"
-        ].iloc[0]
-        limite_superior = promedio * 1.3
-        limite_inferior = promedio * 0.7
-        # Asignar el valor recortado usando .loc para evitar advertencias de SettingWithCopy
-        grupo.loc[:, "Tarifa"] = grupo["Tarifa"].clip(lower=limite_inferior, upper=limite_superior)
-        return grupo
-
-    tarifas_combined_final = tarifas_combined_final.groupby(["ID_Suministro", "Periodo"]).apply(
-        lambda g: ajustar_limites(g, promedio_tarifas)
-    ).reset_index(drop=True)
-
-    # Cambiar el nombre de la columna "Tarifa" a "Tarifa_ajustada"
-    tarifas_combined_final.rename(columns={"Tarifa": "Tarifa_ajustada"}, inplace=True)
-    
-    tarifas_original = tarifas_actualizadas[["SiteID", "SUMINISTRO_ACTUAL", "DISTRIBUIDOR", "PROVEEDOR", "Tipo_Tarifa", "AñoMes", "Tarifa", "ID_Suministro", "Fuente"]]
-    tarifas_actualizadas_2 = pd.merge(tarifas_original, tarifas_combined_final[["ID_Suministro", "AñoMes", "Periodo", "Tarifa_ajustada"]], on=["ID_Suministro", "AñoMes"], how="outer")
-    tarifas_actualizadas_2 = tarifas_actualizadas_2.merge(periodos_disponibles, on="ID_Suministro", how="left")
-    print(f"Columnas en tarifas_actualizadas_2: {tarifas_actualizadas_2.columns.tolist()}")
-    tarifas_actualizadas_2.to_sql("tarifas", conn, if_exists="replace", index=False, chunksize=5000)
+        if afectados:
+            _suministros_calculo(conn, afectados)
+            tarifas_afectadas = pd.read_sql_query("SELECT * FROM tarifas WHERE ID_Suministro IN (SELECT ID_Suministro FROM _suministros_calculo)", conn)
+            reemplazar_filas(conn, calcular_tarifas(tarifas_afectadas, fechas_swap), "tarifas", "ID_Suministro", afectados)
 
     print("Datos de tarifas actualizados en 'tarifas'.")
     
@@ -978,17 +2440,16 @@ def analisis_tarifas(conn, data_folder):
         "No"
     )
     suministros_id["Servicios"] = np.where(suministros_id["Ahorro_PSF"] == "No", "Otros", suministros_id["Servicios"])
-    info_sumi=tarifas_actualizadas_2[["DISTRIBUIDOR", "PROVEEDOR", "ID_Suministro", "PeriodosDisponibles"]]
+    info_sumi = pd.read_sql_query('SELECT DISTRIBUIDOR, PROVEEDOR, ID_Suministro, PeriodosDisponibles FROM tarifas ORDER BY ID_Suministro, "AñoMes"', conn)
     info_sumi = info_sumi.drop_duplicates(subset=["ID_Suministro"])
     suministros_id = pd.merge(suministros_id, info_sumi, on="ID_Suministro", how="left")
 
-    suministros_id.to_sql("suministros_id", conn, if_exists="replace", index=False, chunksize=5000)
+    escribir_tabla(conn, suministros_id, "suministros_id")
 
-    # **Mover archivos procesados**
-    for file in all_files:
-        old_path = os.path.join(data_folder, file)
-        new_path = os.path.join(processed_folder, file.replace(".xlsx", "_procesado.xlsx"))
-        os.rename(old_path, new_path)
+    # **Registrar archivos procesados**
+    with transaccion(conn):
+        for archivo in archivos:
+            registrar_ingesta(conn, archivo, filas_por_archivo.get(os.path.basename(archivo["Ruta"]), 0))
     
 
 def analisis_tarifas_ahorro_real_estimación_proyección(conn):
@@ -1125,8 +2586,8 @@ def analisis_tarifas_ahorro_real_estimación_proyección(conn):
     guia_df["PorcentajeAhorro_Real"] = pd.to_numeric(guia_df["PorcentajeAhorro_Real"], errors='coerce')
     guia_df["PromedioAntesSwap"] = pd.to_numeric(guia_df["PromedioAntesSwap"], errors='coerce')
     print(f"Cantidad de filas en guia_df: {len(guia_df)}")
-    porcentaje_ahorro_guia = guia_df["PorcentajeAhorro_Real"].nsmallest(len(guia_df) - 30).nlargest(len(guia_df) - 60).mean() 
-    promedio_antes_swap_guia = guia_df["PromedioAntesSwap"].nsmallest(len(guia_df) - 30).nlargest(len(guia_df) - 60).mean()
+    porcentaje_ahorro_guia = est.media_recortada(guia_df, None, "PorcentajeAhorro_Real", est.NIVELES_GUIA)
+    promedio_antes_swap_guia = est.media_recortada(guia_df, None, "PromedioAntesSwap", est.NIVELES_GUIA)
 
     print(f"Porcentaje de ahorro guía: {porcentaje_ahorro_guia:.2%}")
     print(f"Promedio de tarifa antes del swap guía: {promedio_antes_swap_guia:.2f}")
@@ -1138,26 +2599,21 @@ def analisis_tarifas_ahorro_real_estimación_proyección(conn):
 
     # Agrupar por Servicios y Tipo_Tarifa
     grouped = df.groupby(["TipoProyecto", "Servicios", "Tipo_Tarifa"], dropna=False)
+    codigos = grouped.ngroup()
+
+    # Promedios con exclusión de extremos (outlier removal) de los confirmados de cada grupo, en una pasada
+    confirmados = df[df["TipoAhorro"] == "Confirmado"].assign(Grupo=codigos)
+    confirmados = confirmados.drop_duplicates(subset=["Grupo", "ID_Suministro"], keep="first")
+    promedios_porcentaje = est.media_recortada(confirmados, "Grupo", "PorcentajeAhorro_Real", est.NIVELES_AHORRO)
+    promedios_tarifa = est.media_recortada(confirmados, "Grupo", "PromedioAntesSwap", est.NIVELES_AHORRO)
+    grupos_confirmados = set(confirmados["Grupo"])
 
     for (tipo, servicio, tarifa), group in grouped:
-        confirmado = group[group["TipoAhorro"] == "Confirmado"]
-        confirmado = confirmado.drop_duplicates(subset=["ID_Suministro"], keep="first")
-
-        if not confirmado.empty:
-            # Calcular promedio con exclusión de extremos (outlier removal)
-            for col in ["PorcentajeAhorro_Real", "PromedioAntesSwap"]:
-                clean = confirmado[col].dropna()
-                if len(clean) > 20:
-                    clean = clean.nsmallest(len(clean) - 4).nlargest(len(clean) - 8)
-                elif len(clean) > 10:
-                    clean = clean.nsmallest(len(clean) - 2).nlargest(len(clean) - 4)
-                elif len(clean) > 5:
-                    clean = clean.nsmallest(len(clean) - 1).nlargest(len(clean) - 2)
-                promedio = clean.mean()
-                if col == "PorcentajeAhorro_Real":
-                    promedio_porcentaje_ahorro = promedio
-                else:
-                    promedio_tarifa_antes = promedio
+        codigo = codigos[group.index[0]]
+
+        if codigo in grupos_confirmados:
+            promedio_porcentaje_ahorro = promedios_porcentaje.get(codigo, np.nan)
+            promedio_tarifa_antes = promedios_tarifa.get(codigo, np.nan)
         else:
             # Usar guía global si no hay confirmados
             promedio_porcentaje_ahorro = porcentaje_ahorro_guia
@@ -1286,10 +2742,10 @@ def analisis_tarifas_ahorro_real_estimación_proyección(conn):
 
     # Guardar los resultados en la base de datos
 
-    df.to_sql("ahorro_estimado_v2", conn, if_exists="replace", index=False)
-    df_salida.to_sql("sitios_clasificados", conn, if_exists="replace", index=False)
-    suministros_id.to_sql("suministros_id", conn, if_exists="replace", index=False)
-    df_grouped.to_sql("promedios_por_suministro", conn, if_exists="replace", index=False)
+    escribir_tabla(conn, df, "ahorro_estimado_v2")
+    escribir_tabla(conn, df_salida, "sitios_clasificados")
+    escribir_tabla(conn, suministros_id, "suministros_id")
+    escribir_tabla(conn, df_grouped, "promedios_por_suministro")
 
 def ahorro_proyectado_v2(conn):
 
@@ -1331,46 +2787,25 @@ def ahorro_proyectado_v2(conn):
 
     # Agrupar por Servicios y Tipo_Tarifa
     grouped = Referencias.groupby(["TipoProyecto", "Servicios", "Tipo_Tarifa"], dropna=False)
+    codigos = grouped.ngroup()
+
+    # Promedios con exclusión de extremos (outlier removal) de cada grupo, en una pasada.
+    # La referencia previa es el promedio antes del swap o, si no hay, el de sitios sin swap.
+    confirmados = Referencias[Referencias["PorcentajeAhorro"].notna() | Referencias["Promedio_SinSwap"].notna()]
+    confirmados = confirmados.assign(
+        Grupo=codigos,
+        Referencia=confirmados["Promedio_AntesSwap"].fillna(confirmados["Promedio_SinSwap"])
+    )
+    promedios_porcentaje = est.media_recortada(confirmados, "Grupo", "PorcentajeAhorro", est.NIVELES_AHORRO)
+    promedios_referencia = est.media_recortada(confirmados, "Grupo", "Referencia", est.NIVELES_AHORRO)
+    grupos_confirmados = set(confirmados["Grupo"])
 
     for (proyecto, servicio, tarifa), group in grouped:
-        confirmado = group[group["PorcentajeAhorro"].notna() | group["Promedio_SinSwap"].notna()]
-        if not confirmado.empty:
-            # Calcular promedio con exclusión de extremos (outlier removal)
-            for col in ["PorcentajeAhorro", "Referencia_Previa"]:
-
-                if col == "PorcentajeAhorro":
-                    clean = confirmado[col].dropna()
-                    clean = clean.infer_objects(copy=False)
-                    if clean.empty:
-                        clean = pd.Series(dtype=float)
-                else:
-                    clean_antes = confirmado["Promedio_AntesSwap"].dropna()
-                    clean_sin = confirmado["Promedio_SinSwap"].dropna()
-                    if not clean_antes.empty and not clean_sin.empty:
-                        clean = clean_antes.combine_first(clean_sin)
-                    elif not clean_antes.empty:
-                        clean = clean_antes
-                    elif not clean_sin.empty:
-                        clean = clean_sin
-                    else:
-                        # los dos vacíos
-                        clean = pd.Series(dtype="float64")
-
-                if len(clean) > 20:
-                    clean = clean.nsmallest(len(clean) - 4).nlargest(len(clean) - 8)
-                elif len(clean) > 10:
-                    clean = clean.nsmallest(len(clean) - 2).nlargest(len(clean) - 4)
-                elif len(clean) > 5:
-                    clean = clean.nsmallest(len(clean) - 1).nlargest(len(clean) - 2)
-                promedio = clean.mean()
-
-                if col == "PorcentajeAhorro":
-                    lenporcentaje = len(clean)
-                    promedio_porcentaje_ahorro = promedio
-                else:
-                    lentarifa=len(clean)
-                    promedio_tarifa_ref = promedio
-            
+        codigo = codigos[group.index[0]]
+        if codigo in grupos_confirmados:
+            promedio_porcentaje_ahorro = promedios_porcentaje.get(codigo, np.nan)
+            promedio_tarifa_ref = promedios_referencia.get(codigo, np.nan)
+
             if pd.notna(promedio_porcentaje_ahorro) and pd.notna(promedio_tarifa_ref):
                 calculo = "Si"
             else:
@@ -1444,8 +2879,8 @@ def ahorro_proyectado_v2(conn):
     ).dropna(subset=["Valor_Proyectado"])
 
     #Guardamos en base de datos
-    ahorro_proyectado_mensual.to_sql("AHORRO_PROYECTADO_MENSUAL_v2", conn, if_exists="replace", index=False)
-    Referencias.to_sql("AHORRO_PROYECTADO_v2", conn, if_exists="replace", index=False)
+    escribir_tabla(conn, ahorro_proyectado_mensual, "AHORRO_PROYECTADO_MENSUAL_v2")
+    escribir_tabla(conn, Referencias, "AHORRO_PROYECTADO_v2")
 
 def export_sqlite_to_csv(conn, output_folder):
     """
@@ -1461,8 +2896,8 @@ def export_sqlite_to_csv(conn, output_folder):
     # Conectar a SQLite
     cursor = conn.cursor()
 
-    # Obtener todas las tablas de SQLite
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    # Obtener todas las tablas de SQLite (las horarias compactas se exportan desde su vista)
+    cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE '%\\_compacta' ESCAPE '\\';")
     tables = cursor.fetchall()
 
     # Exportar cada tabla a un archivo CSV
@@ -1,7 +1,7 @@
-import sqlite3
 import funciones as fn
 import traceback
 import os
+from contextlib import nullcontext
 
 def eliminar_tablas(conn):
     """
@@ -23,7 +23,9 @@ def eliminar_tablas(conn):
         print(f"📋 Tabla '{table}': \n{', '.join(columns)}")
         
     # Filtrar tablas que no deben ser eliminadas
-    tablas_protegidas = {"EnergyConsumption", "TrafficData","tarifas"}
+    tablas_protegidas = {"EnergyConsumption", "TrafficData","tarifas", "ingesta_archivos",
+                         "Sitios", "EnergyConsumption_compacta", "TrafficData_compacta",
+                         "ventanas_analisis", "calendario_etapas"}
     tables = [table for table in tables if table not in tablas_protegidas]
 
     # Preguntar si el usuario desea hacer cambios
@@ -49,12 +51,18 @@ def eliminar_tablas(conn):
 def main():
     """
     FLUJO PRINCIPAL DEL SCRIPT:
-    1. Conexión a base de datos SQLite en carpeta específica de OneDrive.
+    1. Conexión a base de datos SQLite en carpeta específica de OneDrive (perfil WAL de carga).
     2. Ejecución secuencial de pasos de procesamiento (energía, tráfico, sitios, etc.).
     3. Exportación final a CSV, incluso si hay errores.
     """
     # Configuración de rutas (ajustar según entorno)
     base_name = "telecom_energy_universal.db"
+    procesos_lectura = max(1, (os.cpu_count() or 1) - 1)  # procesos para leer archivos NetEco/tráfico
+    procesos_consumo = max(1, (os.cpu_count() or 1) - 1)  # procesos para el análisis de consumo por sitio
+    modo_ligero = False  # True: category/float32 en consumo y clusters (menos memoria con historia completa)
+    reportar_memoria = False  # True: informar el pico de memoria de los análisis (tracemalloc, más lento)
+    bloque_carga = None  # filas por bloque para cargas en streaming (None = todo en memoria)
+    esquema_compacto = False  # True: tablas horarias con claves enteras (migración única)
     user_profile = os.environ.get("USERPROFILE") 
     folder_route = os.path.join(user_profile, "OneDrive", "Telefonica PSF", "Data")
     
@@ -66,55 +74,76 @@ def main():
     base_route = os.path.join(folder_route, base_name)
 
     try:
-        # Abrir conexión a la base de datos (se crea si no existe)
-        conn = sqlite3.connect(base_route)
+        # Abrir conexión a la base de datos (se crea si no existe) con el perfil de carga masiva
+        conn = fn.conectar(base_route, perfil="carga")
         print("\n✅ Conexión a la base de datos establecida correctamente.")
 
         # Paso opcional: eliminar tablas existentes para partir de cero
         #eliminar_tablas(conn)
 
+        # Paso opcional: esquema compacto para EnergyConsumption y TrafficData
+        if esquema_compacto:
+            fn.migrar_esquema_compacto(conn)
+
+        # Crear los índices declarados que falten en las tablas existentes
+        fn.recrear_indices(conn)
+
+        # Pasos 2 y 3: en modo streaming cada bloque confirma su propia transacción
+        # (memoria y journal acotados), por eso no se agrupan en una transacción de etapa
+        etapa_carga = nullcontext if bloque_carga else fn.transaccion
+
         # Paso 2: procesar archivos de energía
-        print("\n🔄 Procesando archivos de energía...")
-        #fn.process_files(conn, os.path.join(folder_route, "DATA_NETECO"), "energy")
+        with etapa_carga(conn):
+            print("\n🔄 Procesando archivos de energía...")
+            #fn.process_files(conn, os.path.join(folder_route, "DATA_NETECO"), "energy", workers=procesos_lectura, chunk_size=bloque_carga)
         print("✅ Procesamiento de archivos de energía completado.")
 
         # Paso 3: procesar archivos de tráfico
-        print("\n🔄 Procesando archivos de tráfico...")
-        #fn.process_files(conn, os.path.join(folder_route, "DATA_TRAFICO"), "traffic")
+        with etapa_carga(conn):
+            print("\n🔄 Procesando archivos de tráfico...")
+            #fn.process_files(conn, os.path.join(folder_route, "DATA_TRAFICO"), "traffic", workers=procesos_lectura, chunk_size=bloque_carga)
         print("✅ Procesamiento de archivos de tráfico completado.")
 
         # Paso 4: consolidar datos de sitios
-        print("\n🔄 Consolidando datos de sitios...")
-        fn.consolidar_datos_sitios(conn, os.path.join(folder_route, "DATA_SITIOS"))
+        with fn.transaccion(conn):
+            print("\n🔄 Consolidando datos de sitios...")
+            fn.consolidar_datos_sitios(conn, os.path.join(folder_route, "DATA_SITIOS"))
         print("✅ Consolidación de datos de sitios completada.")
 
         # Paso 5: calcular etapas de los sitios
-        print("\n🔄 Calculando etapas de los sitios...")
-        #fn.calcular_etapas_sitios(conn, os.path.join(folder_route, "DATA_SITIOS"))
+        with fn.transaccion(conn):
+            print("\n🔄 Calculando etapas de los sitios...")
+            #fn.calcular_etapas_sitios(conn, os.path.join(folder_route, "DATA_SITIOS"))
         print("✅ Cálculo de etapas de los sitios completado.")
 
         # Paso 6: análisis de consumo y actualización de etapas
-        print("\n📊 Iniciando análisis de consumo...")
-        #fn.calcular_consumo(conn)
-        #fn.actualizar_etapas(conn)
+        with fn.transaccion(conn), fn.medir_memoria("Análisis de consumo", activo=reportar_memoria):
+            print("\n📊 Iniciando análisis de consumo...")
+            #fn.calcular_consumo(conn, workers=procesos_consumo, ligero=modo_ligero)
+            #fn.actualizar_etapas(conn)
         print("✅ Análisis de consumo completado.")
 
         # Paso 7: análisis de clusters
-        print("\n📈 Iniciando análisis de clusters...")
-        #fn.analisis_cluster(conn)
+        with fn.transaccion(conn), fn.medir_memoria("Análisis de clusters", activo=reportar_memoria):
+            print("\n📈 Iniciando análisis de clusters...")
+            #fn.analisis_cluster(conn, ligero=modo_ligero)
+            # Cubos de agregados para cortes por Departamento, Región, etc. (fn.consultar_cubo)
+            fn.construir_cubos(conn)
         print("✅ Análisis de clusters completado.")
 
         # Paso 8: análisis de tarifas y ahorro
-        print("\n💰 Iniciando análisis de tarifas...")
-        fn.analisis_tarifas(conn, os.path.join(folder_route, "DATA_TARIFAS"))
-        print("\n💡 Cálculo de ahorro en proceso")
-        fn.analisis_tarifas_ahorro_real_estimación_proyección(conn)
-        fn.ahorro_proyectado_v2(conn)
+        with fn.transaccion(conn):
+            print("\n💰 Iniciando análisis de tarifas...")
+            fn.analisis_tarifas(conn, os.path.join(folder_route, "DATA_TARIFAS"))
+            print("\n💡 Cálculo de ahorro en proceso")
+            fn.analisis_tarifas_ahorro_real_estimación_proyección(conn)
+            fn.ahorro_proyectado_v2(conn)
         print("✅ Análisis de tarifas completado.")
 
         # Paso 9: cálculo final de ahorro proyectado
-        print("\n💡 Calculando ahorro proyectado...")
-        fn.ahorro_proyectado_v2(conn)
+        with fn.transaccion(conn):
+            print("\n💡 Calculando ahorro proyectado...")
+            fn.ahorro_proyectado_v2(conn)
         print("✅ Cálculo de ahorro proyectado completado.")
 
     except Exception:
@@ -125,7 +154,7 @@ def main():
     finally:
         # Exportar toda la base de datos a CSV antes de cerrar conexión
         fn.export_sqlite_to_csv(conn, os.path.join(folder_route, "DATA_SALIDA"))
-        conn.close()
+        fn.cerrar_conexion(conn)
         print("\n🔒 Conexión a la base de datos cerrada.")
 
 # Ejecutar main solo si este script se corre directamente
@@ -1,9 +1,19 @@
 import os
+import sqlite3
+import funciones as fn
 
 # Ruta de la carpeta donde se encuentran los archivos
 carpeta = r"C:\Users\ASUS\OneDrive\Telefonica PSF\Data\DATA_TARIFAS"
+base_route = r"C:\Users\ASUS\OneDrive\Telefonica PSF\Data\telecom_energy_universal.db"
 
-# Iterar sobre los archivos en la carpeta
+# Los archivos ya no se renombran al procesarse: para reprocesarlos basta con
+# quitarlos del registro de ingesta (opcionalmente por rango de fechas con desde/hasta)
+conn = sqlite3.connect(base_route)
+quitados = fn.olvidar_ingesta(conn, carpeta=carpeta)
+conn.close()
+print(f"{quitados} archivos quitados del registro de ingesta.")
+
+# Archivos renombrados con el esquema anterior (_procesado)
 for nombre_archivo in os.listdir(carpeta):
     if "_procesado" in nombre_archivo:
         # Crear el nuevo nombre del archivo
@@ -14,4 +24,4 @@ for nombre_archivo in os.listdir(carpeta):
             os.path.join(carpeta, nuevo_nombre)
         )
 
-print("Renombrado completado.")
\ No newline at end of file
+print("Renombrado completado.")